@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+'''
+Micro-benchmark for decoding API responses.
+
+Compares the previous approach (json.loads followed by a recursive
+strip_unicode() walk) with lib.util.decode_json(), which converts strings
+from inside the decoder. The payload looks like a large /ips/ search.
+
+Usage: bench/bench_decode.py [--records 100000] [--repeat 3]
+'''
+import os
+import sys
+import json
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'lib'))
+from util import decode_json
+
+
+def strip_unicode(obj):
+    '''lib.util.strip_unicode as it was before decode_json replaced it.'''
+    if obj is None:
+        return None
+    elif isinstance(obj, (str, unicode)):
+        return str(obj)
+    elif isinstance(obj, (int, float, bool)):
+        return type(obj)(obj)
+    elif isinstance(obj, dict):
+        new = {}
+        for k, v in obj.iteritems():
+            nk = strip_unicode(k)
+            new[nk] = strip_unicode(v)
+        return new
+    elif isinstance(obj, list):
+        new = []
+        for v in obj:
+            new.append(strip_unicode(v))
+        return new
+    return obj
+
+
+def payload(records):
+    '''Returns a serialized search result with the given number of records.'''
+    return json.dumps({'total_count': records, 'ips': [
+        {'id': i, 'ip': '10.{}.{}.{}'.format(i >> 16 & 255, i >> 8 & 255, i & 255),
+         'subnet_id': i // 250, 'subnet': 'subnet-{}'.format(i // 250),
+         'device': 'dev-{}'.format(i % 5000), 'available': 'no', 'label': '',
+         'type': 'static', 'mac_address': None, 'notes': '',
+         'tags': ['bench', 'rack-{}'.format(i % 40)]}
+        for i in range(records)]})
+
+
+def best(function, text, repeat):
+    '''Returns the fastest of repeat runs, in seconds.'''
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        function(text)
+        times.append(time.time() - start)
+    return min(times)
+
+
+def main():
+    '''Times each decoder on a generated payload and prints the results.'''
+    parser = argparse.ArgumentParser(description='Benchmark json decoding')
+    parser.add_argument('--records', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    text = payload(args.records)
+    assert strip_unicode(json.loads(text)) == decode_json(text)
+
+    before = best(lambda t: strip_unicode(json.loads(t)), text, args.repeat)
+    after = best(decode_json, text, args.repeat)
+    plain = best(json.loads, text, args.repeat)
+
+    print('{} records, {:.1f} MiB'.format(args.records, len(text) / 1048576.0))
+    print('{:<34} {:>8.3f}s'.format('json.loads (no conversion)', plain))
+    print('{:<34} {:>8.3f}s'.format('json.loads + strip_unicode', before))
+    print('{:<34} {:>8.3f}s  ({:.1f}x)'.format('decode_json', after, before / after))
+
+
+if __name__ == '__main__':
+    main()
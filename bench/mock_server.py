@@ -0,0 +1,338 @@
+#!/usr/bin/env python
+'''
+A local stand-in for the Device42 API, serving synthetic data.
+
+It answers the endpoints used by mods/*.py with a dataset of configurable
+size, can delay every response to simulate a remote appliance, and counts
+requests and bytes so benchmarks can report them.
+
+With --capacity, requests beyond that many in progress at once are answered
+with 429, like an overloaded appliance. Responses are gzipped for clients
+that accept it, unless --no-gzip is given.
+
+Usage: bench/mock_server.py [--port 8642] [--size 1000] [--latency 0] [--capacity 0] [--no-gzip]
+    D42_API_URL=http://127.0.0.1:8642/api/ D42_API_USER=x D42_API_PASS=x ./d42-cli -si
+
+GET /_stats returns the counters; GET /_reset zeroes them.
+'''
+import sys
+import json
+import time
+import zlib
+import urlparse
+import argparse
+import threading
+import SocketServer
+import BaseHTTPServer
+
+
+def dataset(size):
+    '''Returns synthetic records for every collection, scaled to size.'''
+    n_subnets = max(1, size // 10)
+    n_vlans = max(1, min(size // 4, 4000))
+    data = {'devices': [], 'ips': [], 'subnets': [], 'vlans': [], 'passwords': []}
+
+    for i in range(1, n_subnets + 1):
+        data['subnets'].append({
+            'subnet_id': i, 'name': 'subnet-{}'.format(i),
+            'network': '10.{}.{}.0'.format(i // 256, i % 256), 'mask_bits': 24,
+            'gateway': '10.{}.{}.1'.format(i // 256, i % 256),
+            'vrf_group_id': None, 'description': '', 'notes': ''})
+
+    for i in range(1, size * 4 + 1):
+        subnet = data['subnets'][(i - 1) % n_subnets]
+        host = ((i - 1) // n_subnets) % 253 + 2
+        data['ips'].append({
+            'id': i, 'ip': subnet['network'][:-1] + str(host),
+            'subnet_id': subnet['subnet_id'], 'subnet': subnet['name'],
+            'device': 'dev-{}'.format((i - 1) % size + 1),
+            'available': 'no', 'label': '', 'type': 'static',
+            'mac_address': None, 'notes': ''})
+
+    for i in range(1, size + 1):
+        data['devices'].append({
+            'device_id': i, 'name': 'dev-{}'.format(i),
+            'serial_no': 'SN{:08d}'.format(i), 'type': 'physical' if i % 3 else 'virtual',
+            'os': 'Debian', 'osver': '8', 'hw_model': 'Model {}'.format(i % 7),
+            'manufacturer': 'Globalscale', 'building': 'st1', 'room': 'r{}'.format(i % 5),
+            'rack': 'rack-{}'.format(i % 40), 'start_at': i % 42, 'in_service': True,
+            'ip_addresses': [{'ip': ip['ip'], 'subnet': ip['subnet']}
+                             for ip in data['ips'][i - 1::size][:4]],
+            'custom_fields': [{'key': 'owner', 'value': 'team-{}'.format(i % 9)}],
+            'tags': ['bench', 'rack-{}'.format(i % 40)], 'notes': '',
+            'last_updated': '2016-01-01T00:00:00Z'})
+
+    for i in range(1, n_vlans + 1):
+        data['vlans'].append({
+            'vlan_id': i, 'number': i + 1, 'name': 'vlan-{}'.format(i),
+            'description': '', 'notes': '',
+            'switches': ['switch-{}'.format(i % 3)] if i % 2 else []})
+
+    for i in range(1, max(1, size // 10) + 1):
+        data['passwords'].append({
+            'id': i, 'username': 'user-{}'.format(i), 'password': 'secret-{}'.format(i),
+            'category': 'bench', 'device': 'dev-{}'.format(i), 'label': ''})
+
+    return data
+
+
+# Collection name => (key in search results, id field)
+COLLECTIONS = {
+    'devices': ('Devices', 'device_id'),
+    'ips': ('ips', 'id'),
+    'subnets': ('subnets', 'subnet_id'),
+    'vlans': ('vlans', 'vlan_id'),
+    'passwords': ('Passwords', 'id'),
+}
+
+# Query string arguments that are not record filters
+CONTROL = ['limit', 'offset', 'plain_text', 'include_cols', 'last_updated_gt']
+
+# Fields reported by /devices/ without /all/
+BRIEF = ['device_id', 'name', 'serial_no', 'type']
+
+
+class MockState(object):
+    '''Data and counters shared by all request handlers.'''
+
+    def __init__(self, size, latency, capacity=0, gzip=True):
+        '''Class initialization'''
+        self.lock = threading.Lock()
+        self.data = dataset(size)
+        self.latency = latency
+        self.capacity = capacity
+        self.gzip = gzip
+        self.active = 0
+        self.reset()
+
+    def reset(self):
+        '''Zeroes the request counters.'''
+        with self.lock:
+            self.stats = {'requests': 0, 'bytes_in': 0, 'bytes_out': 0,
+                          'connections': 0, 'rejected': 0}
+
+
+class MockHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''Serves the Device42 API from a MockState.'''
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    wbufsize = -1
+    state = None
+    counted = False     # This request counts against capacity
+
+    def setup(self):
+        '''Counts each new connection.'''
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        with self.state.lock:
+            self.state.stats['connections'] += 1
+
+    def log_message(self, *args):
+        '''Keeps the access log off stderr.'''
+        pass
+
+    def reply(self, code, body):
+        '''Sends body as json, gzipped if large and the client accepts it.'''
+        payload = json.dumps(body)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        # Small bodies are not worth compressing, as with nginx gzip_min_length
+        if self.state.gzip and len(payload) > 1024 \
+                and 'gzip' in self.headers.get('Accept-Encoding', ''):
+            packer = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            payload = packer.compress(payload) + packer.flush()
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+        with self.state.lock:
+            self.state.stats['bytes_out'] += len(payload)
+            if self.counted:
+                self.state.active -= 1
+                self.counted = False
+
+    def _request(self):
+        '''Returns path parts under /api/<ver>/, query arguments and form body.
+        Returns None after answering 429 if the server is over capacity.'''
+        url = urlparse.urlparse(self.path)
+        query = dict(urlparse.parse_qsl(url.query))
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else ''
+        form = dict(urlparse.parse_qsl(body))
+        with self.state.lock:
+            self.state.stats['requests'] += 1
+            self.state.stats['bytes_in'] += length
+            self.state.active += 1
+            self.counted = True
+            busy = self.state.capacity and self.state.active > self.state.capacity
+            if busy:
+                self.state.stats['rejected'] += 1
+        if busy:
+            self.reply(429, {'msg': 'Too many requests', 'code': 4})
+            return None
+        parts = [p for p in url.path.split('/') if p]
+        if self.state.latency:
+            time.sleep(self.state.latency)
+        return parts, query, form
+
+    def _find(self, name, field, value):
+        '''Returns the first record of a collection whose field equals value.'''
+        for record in self.state.data[name]:
+            if str(record.get(field)) == str(value):
+                return record
+        return None
+
+    def do_GET(self):
+        '''Serves stats, single records and paged searches.'''
+        if self.path == '/_stats':
+            return self.reply(200, self.state.stats)
+        if self.path == '/_reset':
+            self.state.reset()
+            return self.reply(200, {})
+
+        request = self._request()
+        if request is None:
+            return
+        parts, query, _ = request
+        if len(parts) < 3 or parts[0] != 'api' or parts[2] not in COLLECTIONS:
+            return self.reply(404, {'msg': 'Not found', 'code': 1})
+        name = parts[2]
+        key, idf = COLLECTIONS[name]
+        rest = parts[3:]
+
+        # Single object lookups
+        if rest and rest != ['all']:
+            if name == 'devices' and len(rest) == 2 and rest[0] in ['id', 'name']:
+                record = self._find(name, 'device_id' if rest[0] == 'id' else 'name', rest[1])
+            else:
+                record = self._find(name, idf, rest[0])
+            if record is None:
+                return self.reply(404, {'msg': 'Object not found', 'code': 2})
+            return self.reply(200, record)
+
+        records = self.state.data[name]
+        filters = dict((k, v) for k, v in query.items() if k not in CONTROL)
+        if filters:
+            records = [r for r in records
+                       if all(str(r.get(k)) == v for k, v in filters.items() if k in r)]
+        if name == 'devices' and rest != ['all']:
+            records = [dict((k, r.get(k)) for k in BRIEF) for r in records]
+        if name == 'devices' and rest == ['all'] and query.get('include_cols'):
+            cols = query['include_cols'].split(',')
+            records = [dict((k, r[k]) for k in cols if k in r) for r in records]
+        if name == 'passwords' and query.get('plain_text') != 'yes':
+            records = [dict(r, password=None) for r in records]
+
+        total = len(records)
+        offset = int(query.get('offset', 0))
+        if 'limit' in query:
+            records = records[offset:offset + int(query['limit'])]
+        return self.reply(200, {key: records, 'total_count': total,
+                                'offset': offset, 'limit': query.get('limit')})
+
+    def do_POST(self):
+        '''Creates or updates a record.'''
+        request = self._request()
+        if request is None:
+            return
+        parts, _, form = request
+        if len(parts) < 3 or parts[0] != 'api':
+            return self.reply(404, {'msg': 'Not found', 'code': 1})
+
+        if parts[2] == 'suggest_ip':
+            subnet = self._find('subnets', 'subnet_id', form.get('subnet_id', 1))
+            if subnet is None:
+                return self.reply(404, {'msg': 'Subnet not found', 'code': 2})
+            used = set(ip['ip'] for ip in self.state.data['ips'])
+            for host in range(2, 255):
+                ip = subnet['network'][:-1] + str(host)
+                if ip not in used:
+                    return self.reply(200, {'ip': ip})
+            return self.reply(400, {'msg': 'Subnet full', 'code': 3})
+
+        name = {'device': 'devices'}.get(parts[2], parts[2])
+        if name not in COLLECTIONS:
+            return self.reply(404, {'msg': 'Not found', 'code': 1})
+        _, idf = COLLECTIONS[name]
+        match = {'devices': 'name', 'ips': 'ip', 'subnets': 'network',
+                 'vlans': 'number', 'passwords': 'id'}[name]
+        value = form.get({'ips': 'ipaddress'}.get(name, match))
+        if len(parts) > 3:
+            match, value = idf, parts[3]
+
+        with self.state.lock:
+            record = self._find(name, match, value) if value else None
+            if record is None:
+                # Ids are not reused after deletes
+                record = {idf: max([r[idf] for r in self.state.data[name]] or [0]) + 1}
+                self.state.data[name].append(record)
+                verb = 'added'
+            else:
+                verb = 'updated'
+            record.update(form)
+            if 'ipaddress' in form:
+                record['ip'] = form['ipaddress']
+        return self.reply(200, {'code': 0, 'msg': ['{} {}'.format(name[:-1], verb),
+                                                   record[idf], value, True, verb == 'added']})
+
+    def do_DELETE(self):
+        '''Deletes a record.'''
+        request = self._request()
+        if request is None:
+            return
+        parts, _, _ = request
+        if len(parts) < 4 or parts[2] not in COLLECTIONS:
+            return self.reply(404, {'msg': 'Not found', 'code': 1})
+        _, idf = COLLECTIONS[parts[2]]
+        with self.state.lock:
+            record = self._find(parts[2], idf, parts[3])
+            if record is None:
+                return self.reply(404, {'msg': 'Object not found', 'code': 2})
+            self.state.data[parts[2]].remove(record)
+        return self.reply(200, {'deleted': 'true', 'id': parts[3]})
+
+
+class MockServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    '''Threaded HTTP server; keep-alive clients each get their own thread.'''
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def start(port=0, size=1000, latency=0.0, capacity=0, gzip=True):
+    '''Starts a mock server in a background thread.
+    Returns the server; server.server_address holds the bound port.'''
+    class Handler(MockHandler):
+        '''MockHandler bound to this server's state.'''
+        state = MockState(size, latency, capacity, gzip)
+
+    server = MockServer(('127.0.0.1', port), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def main():
+    '''Runs a mock server in the foreground.'''
+    parser = argparse.ArgumentParser(description='Mock Device42 API server')
+    parser.add_argument('--port', type=int, default=8642)
+    parser.add_argument('--size', type=int, default=1000, help='Number of devices')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Seconds added to every response')
+    parser.add_argument('--capacity', type=int, default=0,
+                        help='Requests handled at once before answering 429; 0 for no limit')
+    parser.add_argument('--no-gzip', dest='gzip', action='store_false',
+                        help='Never compress responses')
+    args = parser.parse_args()
+
+    server = start(args.port, args.size, args.latency, args.capacity, args.gzip)
+    sys.stderr.write('Mock Device42 API at http://127.0.0.1:{}/api/\n'.format(
+        server.server_address[1]))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
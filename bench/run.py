@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+'''
+End-to-end benchmarks for d42-cli, run against bench/mock_server.py.
+
+Every op_* function in mods/ is run as its own d42-cli process, the same
+way a user would run it. Each scenario reports wall time, the number of API
+requests, bytes transferred and the peak RSS of the process. Cold start
+(--version) is checked against a time budget, and also reported when
+forwarded to a running --daemon.
+
+Usage: bench/run.py [--size 1000] [--latency 0] [--capacity 0] [--no-gzip] [--repeat 3] [--only NAME]
+                    [--json FILE] [--baseline FILE] [--tolerance 0.25]
+
+Exit status is 1 if a scenario exits unexpectedly, cold start is over
+budget, or a scenario is slower than the baseline by more than tolerance.
+'''
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import urllib2
+import argparse
+import tempfile
+import subprocess
+
+import mock_server
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# (name, operation function, arguments, expected exit status)
+# {n} is replaced with the repeat number so writes do not collide.
+SCENARIOS = [
+    ('search-devices', 'device.op_search_devices', ['--search-devices'], 0),
+    ('search-devices-verbose', 'device.op_search_devices', ['--search-devices', '-v'], 0),
+    ('search-devices-paged', 'device.op_search_devices', ['--search-devices', '-v', '--page-size', '500'], 0),
+    ('search-devices-stream', 'device.op_search_devices', ['--search-devices', '-v', '--stream', '--out', 'ndjson'], 0),
+    ('search-devices-fields', 'device.op_search_devices', ['--search-devices', '--fields', 'name,serial_no,ip_addresses'], 0),
+    ('search-devices-table', 'device.op_search_devices', ['--search-devices', '--page-size', '500',
+                                                          '--fields', 'name,serial_no,type', '--out', 'table'], 0),
+    ('get-device', 'device.op_get_device', ['--get-device', '-p', 'device_name=dev-1'], 0),
+    ('create-device', 'device.op_create_device', ['--create-device', '-p', 'name=bench-{n}'], 0),
+    ('update-device', 'device.op_update_device', ['--update-device', '-p', 'name=dev-2', '-p', 'osver=9'], 0),
+    ('import-devices', 'device.op_import_devices', ['--import-devices', '-p', 'file={devices}'], 0),
+    ('search-ips', 'ipaddr.op_search_ips', ['--search-ips'], 0),
+    ('search-ips-paged', 'ipaddr.op_search_ips', ['--search-ips', '--page-size', '1000'], 0),
+    ('search-ips-stream', 'ipaddr.op_search_ips', ['--search-ips', '--page-size', '5000', '--stream', '--out', 'ndjson'], 0),
+    ('search-ips-csv', 'ipaddr.op_search_ips', ['--search-ips', '--page-size', '1000', '--out', 'csv'], 0),
+    ('search-ips-pool', 'ipaddr.op_search_ips', ['--search-ips', '--page-size', '250', '--engine', 'pool'], 0),
+    ('get-ip', 'ipaddr.op_get_ip', ['--get-ip', '-p', 'ip_id=1'], 0),
+    # These operations return None on success, which d42-cli reports as 8
+    ('create-ip', 'ipaddr.op_create_ip', ['--create-ip', '-p', 'ipaddress=10.250.0.{n}'], 8),
+    ('update-ip', 'ipaddr.op_update_ip', ['--update-ip', '-p', 'ipaddress=10.0.1.2', '-p', 'label=x'], 0),
+    ('request-ip', 'ipaddr.op_request_ip', ['--request-ip', '-p', 'subnet_id=1', '-p', 'reserve_ip=yes'], 0),
+    ('reserve-ips', 'ipaddr.op_reserve_ips', ['--reserve-ips', '-p', 'subnet_id={n}', '-p', 'count=50',
+                                              '--concurrency', '8'], 0),
+    ('delete-ip', 'ipaddr.op_delete_ip', ['--delete-ip', '--yes', '-p', 'ip_id={n}'], 0),
+    ('search-subnets', 'subnet.op_search_subnets', ['--search-subnets'], 0),
+    ('get-subnet', 'subnet.op_get_subnet', ['--get-subnet', '-p', 'subnet_id=1'], 0),
+    ('create-subnet', 'subnet.op_create_subnet', ['--create-subnet', '-p', 'network=192.168.{n}.0',
+                                           '-p', 'mask_bits=24', '-p', 'name=bench-{n}'], 8),
+    ('update-subnet', 'subnet.op_update_subnet', ['--update-subnet', '-p', 'network=10.0.1.0',
+                                           '-p', 'mask_bits=24', '-p', 'notes=x'], 0),
+    ('lookup-subnets', 'subnet.op_lookup_subnets', ['--lookup-subnets', '-p', 'file={addresses}'], 0),
+    ('subnet-usage', 'subnet.op_subnet_usage', ['--subnet-usage', '--out', 'ndjson'], 0),
+    ('delete-subnet', 'subnet.op_delete_subnet', ['--delete-subnet', '--yes', '-p', 'subnet_id={n}'], 0),
+    ('search-vlans', 'vlan.op_search_vlans', ['--search-vlans'], 0),
+    ('get-vlan', 'vlan.op_get_vlan', ['--get-vlan', '-p', 'vlan_id=1'], 0),
+    ('create-vlan', 'vlan.op_create_vlan', ['--create-vlan', '-p', 'number={vlan}', '-p', 'name=bench'], 0),
+    ('update-vlan', 'vlan.op_update_vlan', ['--update-vlan', '-p', 'id=2', '-p', 'notes=x'], 0),
+    ('delete-vlan', 'vlan.op_delete_vlan', ['--delete-vlan', '--yes', '-p', 'vlan_id={n}'], 0),
+    ('free-vlans', 'vlan.op_free_vlans', ['--free-vlans', '-p', 'count=100'], 0),
+    # Every vlan listed, a handful changed
+    ('apply', 'reconcile.op_apply', ['--apply', '--yes', '-p', 'file={state}'], 0),
+    ('search-passwords', 'password.op_search_passwords', ['--search-passwords'], 0),
+    ('get-password', 'password.op_get_password', ['--get-secret', '--out', 'raw', '-p', 'username=user-5'], 0),
+    ('create-password', 'password.op_create_password', ['--create-password', '-p', 'username=bench',
+                                               '-p', 'password=bench'], 8),
+    ('update-password', 'password.op_update_password', ['--update-password', '-p', 'id=2', '-p', 'label=x'], 0),
+    ('delete-password', 'password.op_delete_password', ['--delete-password', '--yes', '-p', 'password_id={n}'], 0),
+    ('panda', 'misc.op_show_panda', ['--panda'], 8),   # Also returns None
+    ('sync', 'sync.op_sync', ['--sync'], 0),
+    # Answered from the snapshot written by the sync scenario
+    ('search-ips-offline', 'ipaddr.op_search_ips', ['--offline', '--search-ips', '-p', 'subnet_id=3'], 0),
+]
+
+
+def operations():
+    '''Returns every op_* function defined in mods/, as module.op_function.'''
+    found = set()
+    mods = os.path.join(ROOT, 'mods')
+    for name in os.listdir(mods):
+        if not name.endswith('.py') or name == '__init__.py':
+            continue
+        with open(os.path.join(mods, name)) as fh:
+            for fun in re.findall(r'^def (op_\w+)\(', fh.read(), re.M):
+                found.add('{}.{}'.format(name[:-3], fun))
+    return found
+
+
+def run(argv, env):
+    '''Runs d42-cli once. Returns (exit status, seconds, peak rss in KiB, stderr).'''
+    with tempfile.TemporaryFile() as err, open(os.devnull, 'w') as out:
+        start = time.time()
+        proc = subprocess.Popen([sys.executable, 'd42-cli'] + argv, cwd=ROOT, env=env,
+                                stdin=subprocess.PIPE, stdout=out, stderr=err)
+        proc.stdin.close()
+        # wait4() rather than wait() to get the peak RSS of this child
+        _, status, usage = os.wait4(proc.pid, 0)
+        elapsed = time.time() - start
+        proc.returncode = status
+        err.seek(0)
+        message = err.read().strip()
+    return os.WEXITSTATUS(status), elapsed, usage.ru_maxrss, message
+
+
+def stats(url, path):
+    '''Returns the counters the mock server reports at path.'''
+    return json.load(urllib2.urlopen('{}{}'.format(url, path)))
+
+
+def median(values):
+    '''Returns the median of values.'''
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def main():
+    '''Runs every scenario and reports, compares or saves the results.'''
+    parser = argparse.ArgumentParser(description='Benchmark d42-cli against a mock server')
+    parser.add_argument('--size', type=int, default=1000, help='Number of devices in the dataset')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added per request')
+    parser.add_argument('--capacity', type=int, default=0,
+                        help='Requests the server handles at once before answering 429')
+    parser.add_argument('--no-gzip', dest='gzip', action='store_false',
+                        help='Mock server never compresses responses')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per scenario; median is kept')
+    parser.add_argument('--only', help='Only run scenarios whose name contains this')
+    parser.add_argument('--startup-budget', type=float, default=0.25,
+                        help='Maximum seconds for a cold "d42-cli --version"')
+    parser.add_argument('--json', help='Write results to this file')
+    parser.add_argument('--baseline', help='Results file from a previous --json run')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='Allowed slowdown against the baseline; 0.25 = 25%%')
+    args = parser.parse_args()
+
+    server = mock_server.start(0, args.size, args.latency, args.capacity, args.gzip)
+    url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+    tmp = tempfile.mkdtemp(prefix='d42-bench-')
+    env = dict(os.environ, D42_API_URL=url + '/api/', D42_API_USER='bench',
+               D42_API_PASS='bench', XDG_CACHE_HOME=tmp)
+    env.pop('D42_CACHE_TTL', None)
+
+    devices = os.path.join(tmp, 'devices.csv')
+    with open(devices, 'w') as fh:
+        fh.write('name,serial_no,os\n')
+        for i in range(1, 101):
+            fh.write('import-{0},IMP{0:05d},Debian\n'.format(i))
+
+    addresses = os.path.join(tmp, 'addresses.txt')
+    with open(addresses, 'w') as fh:
+        for i in range(args.size):
+            fh.write('10.{}.{}.{}\n'.format(i // 65536 % 256, i // 256 % 256, i % 256))
+
+    # Desired state matching the mock's vlans (number i + 1, name vlan-i), with a few renamed
+    state = os.path.join(tmp, 'state.json')
+    with open(state, 'w') as fh:
+        vlans = [{'number': i + 1, 'name': 'vlan-{}'.format(i) if i % 100 else 'bench-{}'.format(i)}
+                 for i in range(1, max(1, min(args.size // 4, 4000)) + 1)]
+        json.dump({'vlans': vlans}, fh)
+
+    missing = operations() - set(s[1] for s in SCENARIOS)
+    for op in sorted(missing):
+        sys.stderr.write('WARNING: no benchmark scenario for {}\n'.format(op))
+
+    failures = []
+    results = {}
+
+    # Cold start; the first run builds the module manifest
+    run(['--version'], env)
+    times = [run(['--version'], env)[1] for _ in range(max(args.repeat, 5))]
+    results['startup'] = {'seconds': min(times), 'requests': 0, 'bytes': 0, 'rss_kib': 0,
+                          'status': 0}
+    if min(times) > args.startup_budget:
+        failures.append('startup took {:.3f}s; budget is {:.3f}s'.format(
+            min(times), args.startup_budget))
+
+    # The same through a resident daemon
+    sock = os.path.join(tmp, 'd42.sock')
+    daemon = subprocess.Popen([sys.executable, 'd42-cli', '--daemon', sock], cwd=ROOT, env=env,
+                              stdin=open(os.devnull), stderr=open(os.devnull, 'w'))
+    for _ in range(100):
+        if os.path.exists(sock):
+            break
+        time.sleep(0.05)
+    client = dict(env, D42_SOCKET=sock)
+    times = [run(['--version'], client)[1] for _ in range(max(args.repeat, 5))]
+    daemon.terminate()
+    daemon.wait()
+    results['startup-daemon'] = {'seconds': min(times), 'requests': 0, 'bytes': 0, 'rss_kib': 0,
+                                 'status': 0}
+
+    for name, _, argv, expect in SCENARIOS:
+        if args.only and args.only not in name:
+            continue
+        runs = []
+        for n in range(1, args.repeat + 1):
+            fmt = {'n': n, 'vlan': 4094 - n, 'devices': devices, 'addresses': addresses,
+                   'state': state}
+            cmd = [a.format(**fmt) for a in argv] + ['--no-cache']
+            if '--out' not in cmd:
+                cmd += ['--out', 'json']
+            stats(url, '/_reset')
+            status, elapsed, rss, message = run(cmd, env)
+            counters = stats(url, '/_stats')
+            runs.append((elapsed, counters, rss))
+            if status != expect:
+                failures.append('{} exited {} (expected {}): {}'.format(
+                    name, status, expect, message.splitlines()[-1:] or ''))
+                break
+
+        elapsed = median([r[0] for r in runs])
+        counters = runs[-1][1]
+        results[name] = {'seconds': elapsed,
+                         'requests': counters['requests'],
+                         'connections': counters['connections'],
+                         'bytes': counters['bytes_in'] + counters['bytes_out'],
+                         'rss_kib': max(r[2] for r in runs),
+                         'status': status}
+
+    server.shutdown()
+    shutil.rmtree(tmp, ignore_errors=True)
+
+    if args.baseline:
+        with open(args.baseline) as fh:
+            baseline = json.load(fh)['results']
+        for name, res in sorted(results.items()):
+            old = baseline.get(name)
+            if old and res['seconds'] > old['seconds'] * (1 + args.tolerance):
+                failures.append('{} regressed: {:.3f}s -> {:.3f}s'.format(
+                    name, old['seconds'], res['seconds']))
+
+    print('{:<26} {:>9} {:>9} {:>6} {:>12} {:>9} {:>7}'.format(
+        'scenario', 'seconds', 'requests', 'conns', 'bytes', 'rss MiB', 'status'))
+    for name, res in sorted(results.items()):
+        print('{:<26} {:>9.3f} {:>9} {:>6} {:>12} {:>9.1f} {:>7}'.format(
+            name, res['seconds'], res['requests'], res.get('connections', 0),
+            res['bytes'], res['rss_kib'] / 1024.0, res['status']))
+
+    if args.json:
+        with open(args.json, 'w') as fh:
+            json.dump({'size': args.size, 'latency': args.latency, 'results': results},
+                      fh, indent=2, sort_keys=True)
+
+    for failure in failures:
+        sys.stderr.write('FAIL: {}\n'.format(failure))
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+'''
+Provides the D42Cache class.
+It keeps responses from the D42 API on disk so repeated queries are cheap.
+
+Environment Variables Read :: XDG_CACHE_HOME
+
+DEFINED EXIT :: none
+'''
+import os
+import json
+import time
+import hashlib
+
+from util import decode_json, compress, decompress
+
+# Resources that must never be written to disk
+UNCACHED = ['password']
+
+# Entries are zlib compressed json
+SUFFIX = '.json.z'
+
+# Writes to these resources change the contents of another
+AFFECTS = {'suggest_ip': 'ip'}
+
+
+def resource(query):
+    '''Returns the resource type an API query works on.
+    /devices/name/foo/ and /device/ are both "device".'''
+    name = query.split('?')[0].strip('/').split('/')[0]
+    if name.endswith('s'):
+        name = name[:-1]
+    return name
+
+
+class D42Cache(object):
+    '''Size-bounded, least recently used cache of API responses.'''
+    path = None
+    ttl = None
+    max_size = 64 * 1024 * 1024
+
+
+    def __init__(self, ttl, path=None):
+        '''Class initialization'''
+        self.ttl = ttl
+        if path is None:
+            base = os.environ.get('XDG_CACHE_HOME',
+                                  os.path.join(os.path.expanduser('~'), '.cache'))
+            path = os.path.join(base, 'd42-cli')
+        self.path = path
+
+
+    def _file(self, query, key):
+        '''Returns the file an entry is stored in.
+        The resource type prefixes the name so it can be invalidated.'''
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.path, '{}-{}{}'.format(resource(query), digest, SUFFIX))
+
+
+    def cacheable(self, query):
+        '''Returns True if responses for the query may be cached.'''
+        return resource(query) not in UNCACHED
+
+
+    def get(self, query, key):
+        '''Returns the stored entry for the query, or None.
+        Entries are dictionaries: time, etag, last_modified, data.'''
+        path = self._file(query, key)
+        try:
+            with open(path, 'rb') as fh:
+                entry = decode_json(decompress(fh.read()))
+            # Mark entry as recently used
+            os.utime(path, None)
+        except (IOError, OSError, ValueError):
+            return None
+        return entry
+
+
+    def fresh(self, entry):
+        '''Returns True if the entry is younger than the cache TTL.'''
+        return time.time() - entry.get('time', 0) < self.ttl
+
+
+    def validators(self, entry):
+        '''Returns the headers needed to revalidate an expired entry.'''
+        headers = dict()
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+
+    def put(self, query, key, data, etag=None, last_modified=None):
+        '''Stores a response and evicts old entries if over size.'''
+        entry = {'time': time.time(),
+                 'etag': etag,
+                 'last_modified': last_modified,
+                 'data': data}
+        path = self._file(query, key)
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        try:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path, 0o700)
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'wb') as fh:
+                fh.write(compress(json.dumps(entry)))
+            os.rename(tmp, path)
+        except (IOError, OSError):
+            return False
+        self._evict()
+        return True
+
+
+    def refresh(self, query, key, entry):
+        '''Restarts the TTL of an entry the server confirmed is unchanged.'''
+        return self.put(query, key, entry['data'],
+                        entry.get('etag'), entry.get('last_modified'))
+
+
+    def invalidate(self, query):
+        '''Drops every entry for the resource type a query works on.'''
+        names = [resource(query)]
+        if names[0] in AFFECTS:
+            names.append(AFFECTS[names[0]])
+        prefixes = tuple('{}-'.format(n) for n in names)
+        for name in self._entries():
+            if name.startswith(prefixes):
+                self._remove(name)
+
+
+    def _entries(self):
+        '''Returns the names of all stored entries.
+        Uncompressed .json entries from older versions are only cleaned up.'''
+        try:
+            return [n for n in os.listdir(self.path) if n.endswith(('.json', SUFFIX))]
+        except OSError:
+            return []
+
+
+    def _remove(self, name):
+        '''Removes an entry; another process may have beat us to it.'''
+        try:
+            os.remove(os.path.join(self.path, name))
+        except OSError:
+            pass
+
+
+    def _evict(self):
+        '''Removes least recently used entries until under max_size.'''
+        entries = []
+        total = 0
+        for name in self._entries():
+            try:
+                st = os.stat(os.path.join(self.path, name))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, name))
+            total += st.st_size
+
+        entries.sort()
+        while total > self.max_size and entries:
+            _, size, name = entries.pop(0)
+            self._remove(name)
+            total -= size
@@ -3,19 +3,42 @@
 This is the main D42 library, providing the D42() class.
 It loads all the bits needed to talk to the D42 web application.
 
-DEFINED EXIT :: 11
+DEFINED EXIT :: 11, 12, 13
 '''
 import json
-import requests
 import os
+import sys
+import time
+import threading
 
-from util import stderr, strip_unicode
+from util import stderr, decode_json, decode_msgpack, is_msgpack, encode, pool_map
 from output import D42Output
+from cache import D42Cache
+from trace import D42Trace, D42NullSpan
+from stream import D42JsonStream
+from throttle import D42Throttle, RETRY_STATUS, retry_after
 
-try:
-    requests.packages.urllib3.disable_warnings()
-except:
-    pass
+# Imported on first API call; not needed for --help or --version
+requests = None
+
+# Searches that accept include_cols, so unrequested fields are never sent
+INCLUDE_COLS = ['/devices/all/']
+
+
+def load_requests():
+    '''Imports the requests library into this module.'''
+    global requests
+    if requests is not None:
+        return requests
+    try:
+        requests = __import__('requests')
+    except ImportError:
+        stderr('Unable to load library: requests', exit_status=13)
+    try:
+        requests.packages.urllib3.disable_warnings()
+    except:
+        pass
+    return requests
 
 
 class D42(object):
@@ -26,18 +49,49 @@ class D42(object):
     api_ver = None
     opts = None
     params = None
+    pool_size = None        # Maximum number of pooled connections
+    engine = None           # serial, or pool to run api_many() calls concurrently
+    throttle = None         # Adaptive concurrency and rate limit; made with the session
+    rate_limit = None       # Requests per second; None for no limit
+    max_retries = None      # Retries of requests the server was too busy for
+    timeout = None          # Seconds to wait for the server; None waits forever
+    session = None          # Shared HTTP session (keep-alive)
+    session_lock = threading.Lock()
+    page_size = None        # Records per page for searches; None disables paging
+    fields = None           # Keys kept in each record shown; None keeps all
+    stream = False          # Parse search results while they download
+    cache_ttl = None        # Seconds a cached GET stays fresh; 0 disables caching
+    cache = None            # On-disk response cache
+    trace = None            # Per-call timing; None unless --trace
+    transfer = None         # [bytes decoded, bytes on the wire] of API responses
+    transfer_lock = threading.Lock()
+    snapshot = None         # Local copy of the inventory
+    offline = False         # Answer queries from the snapshot only
+    bulk = False            # Existence checks use whole-collection indexes
+    bulk_checks = 0         # Checks of a collection made one at a time before it is indexed
+    indexes = None          # Name => set of keys of existing objects
+    index_checks = None     # Name => existence checks made so far
+    index_lock = threading.Lock()
     mods_list = None        # List of modules that should be loaded
-    modules_loaded = []     # Modules that have been loaded
-    outputter = D42Output()
-    err_list = []
+    manifest = None         # File caching the options provided by modules
+    modules_loaded = None   # Modules that have been loaded
+    operations = None       # Maps operation flags to operation names
+    outputter = None        # D42Output for this request
+    err_list = None         # Exit statuses of errors reported with err()
 
 
     def __init__(self):
         '''Class initialization'''
         self.opts = dict()
         self.params = dict()
+        self.indexes = dict()
+        self.index_checks = dict()
+        # Per instance, so requests served by a daemon do not share them
+        self.modules_loaded = list()
+        self.outputter = D42Output()
+        self.err_list = list()
+        self.transfer = [0, 0]
         self.prepare_attributes()
-        self.load_modules()
 
 
     def prepare_attributes(self):
@@ -46,6 +100,14 @@ class D42(object):
             self.api_url = 'https://d42.suitabletech.com/api/'
         if not self.api_ver:
             self.api_ver = '1.0'
+        if not self.pool_size:
+            self.pool_size = 10
+        if not self.engine:
+            self.engine = 'serial'
+        if self.max_retries is None:
+            self.max_retries = 3
+        if not self.manifest:
+            self.manifest = os.path.join('mods', 'manifest.json')
         if self.mods_list is None:
             self.mods_list = ['mods.{}'.format(i[:-3]) for i in os.listdir('mods')
                     if i.endswith('.py') and i != '__init__.py']
@@ -64,13 +126,90 @@ class D42(object):
             if opts.d42_pass is not None:
                 self.api_pass = opts.d42_pass
 
+        if hasattr(opts, 'd42_pool_size'):
+            if opts.d42_pool_size is not None:
+                if opts.d42_pool_size < 1:
+                    stderr('Connection pool size must be at least 1.', exit_status=11)
+                self.pool_size = opts.d42_pool_size
+
+        if hasattr(opts, 'd42_engine'):
+            if opts.d42_engine is not None:
+                self.engine = opts.d42_engine
+
+        if hasattr(opts, 'd42_rate_limit'):
+            if opts.d42_rate_limit is not None:
+                if opts.d42_rate_limit <= 0:
+                    stderr('Rate limit must be above 0.', exit_status=11)
+                self.rate_limit = opts.d42_rate_limit
+        if hasattr(opts, 'd42_max_retries'):
+            if opts.d42_max_retries is not None:
+                self.max_retries = max(0, opts.d42_max_retries)
+        if hasattr(opts, 'd42_timeout'):
+            if opts.d42_timeout is not None:
+                self.timeout = opts.d42_timeout
+
+        if hasattr(opts, 'd42_page_size'):
+            if opts.d42_page_size is not None:
+                if opts.d42_page_size < 1:
+                    stderr('Page size must be at least 1.', exit_status=11)
+                self.page_size = opts.d42_page_size
+
+        if hasattr(opts, 'd42_fields'):
+            if opts.d42_fields is not None:
+                self.fields = [f.strip() for f in opts.d42_fields.split(',') if f.strip()]
+                if not self.fields:
+                    stderr('No fields given to --fields.', exit_status=11)
+                # Tabular outputters show them in the order given
+                self.outputter.columns = self.fields
+
+        if hasattr(opts, 'd42_stream'):
+            if opts.d42_stream:
+                self.stream = True
+
+        if hasattr(opts, 'd42_cache_ttl'):
+            if opts.d42_cache_ttl is not None:
+                self.cache_ttl = opts.d42_cache_ttl
+        if hasattr(opts, 'd42_no_cache'):
+            if opts.d42_no_cache:
+                self.cache_ttl = 0
+        if self.cache_ttl and self.cache_ttl > 0:
+            self.cache = D42Cache(self.cache_ttl)
+        else:
+            self.cache = None
+
+        if hasattr(opts, 'd42_trace'):
+            if opts.d42_trace is not None:
+                try:
+                    self.trace = D42Trace(opts.d42_trace)
+                except IOError:
+                    stderr('Unable to open trace file.', exit_status=11)
+
+        if hasattr(opts, 'd42_offline'):
+            if opts.d42_offline:
+                self.offline = True
+
         if hasattr(opts, 'd42_params'):
             if opts.d42_params is not None:
+                params = opts.d42_params
+                if params.startswith('@'):
+                    # Read from a file (or stdin), which may hold msgpack
+                    try:
+                        if params == '@-':
+                            params = sys.stdin.read()
+                        else:
+                            with open(params[1:], 'rb') as fh:
+                                params = fh.read()
+                    except IOError:
+                        stderr('Unable to read parameters from {}'.format(params[1:]),
+                               exit_status=11)
                 try:
-                    self.params = json.loads(opts.d42_params)
-                except:
-                    stderr('Unable to parse parameters; is it valid serialized json?',
-                           exit_status=11)
+                    if is_msgpack(params):
+                        self.params = decode_msgpack(params)
+                    else:
+                        self.params = json.loads(params)
+                except Exception as e:
+                    stderr('Unable to parse parameters ({}); is it valid serialized json '
+                           'or msgpack?'.format(e), exit_status=11)
         if hasattr(opts, 'd42_prm'):
             if opts.d42_prm is not None:
                 for param in opts.d42_prm:
@@ -88,59 +227,224 @@ class D42(object):
             self.api_url = self.api_url + '/'
 
 
+    def __getattr__(self, name):
+        '''Loads modules from mods_list on first use.
+        Only called for attributes that are not already set.'''
+        nam = 'mods.{}'.format(name)
+        if name.startswith('_') or not self.mods_list or nam not in self.mods_list:
+            raise AttributeError(name)
+        if not self.load_module(nam):
+            raise AttributeError(name)
+        return getattr(self, name)
+
+
     def load_modules(self):
         '''Attempts to load all modules in mods_list'''
-        com = None
         if not self.mods_list:
             stderr('No modules loaded', 'NOTICE')
             return None
 
         for nam in self.mods_list:
-            try:
-                mod = __import__(nam)
-                components = nam.split('.')
-                for com in components[1:]:
-                    mod = getattr(mod, com)
-                setattr(self, com, mod)
-                self.modules_loaded.append(com)
-            except:
-                stderr('Unable to load module {}'.format(nam), 'NOTICE')
+            self.load_module(nam)
+
+
+    def load_module(self, nam):
+        '''Attempts to load a single module from mods_list'''
+        com = None
+        try:
+            mod = __import__(nam)
+            components = nam.split('.')
+            for com in components[1:]:
+                mod = getattr(mod, com)
+            setattr(self, com, mod)
+            self.modules_loaded.append(com)
+        except:
+            stderr('Unable to load module {}'.format(nam), 'NOTICE')
+            return False
+        return True
+
+
+    def get_session(self):
+        '''Returns the HTTP session shared by every API call, creating it on
+        first use. Connections are kept alive and reused between calls.'''
+        with self.session_lock:
+            if self.session is None:
+                load_requests()
+                adapter = requests.adapters.HTTPAdapter(
+                    pool_connections=self.pool_size,
+                    pool_maxsize=self.pool_size)
+                session = requests.Session()
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                # Responses are repetitive json; ask for them compressed
+                session.headers['Accept-Encoding'] = 'gzip, deflate'
+                # The pool size is final once the session exists
+                self.throttle = D42Throttle(self.pool_size, self.rate_limit)
+                self.session = session
+        return self.session
+
+
+    def get_snapshot(self):
+        '''Returns the local inventory snapshot for this API url.'''
+        if self.snapshot is None:
+            # Imported here; sqlite3 and friends are only needed by --sync and --offline
+            from snapshot import D42Snapshot
+            self.snapshot = D42Snapshot(self.api_url)
+        return self.snapshot
+
+
+    def _connections(self, session, url):
+        '''Returns how many connections have been opened to the host of url.
+        Only counted while tracing.'''
+        if self.trace is None:
+            return None
+        try:
+            adapter = session.get_adapter(url)
+            return adapter.poolmanager.connection_from_url(url).num_connections
+        except:
+            return None
 
 
-    def api(self, query, post=None, delete=False):
-        '''Performs an API query and returns the results'''
+    def api(self, query, post=None, delete=False, records=None):
+        '''Performs an API query and returns the results.
+        If records names the array of a GET response, its data is a
+        D42JsonStream parsing that array as it downloads (never cached).'''
         if not query:
             return {'result': False,
                     'data': 'No API query provided.'}
+        if self.offline:
+            span = self.span('api', method='DELETE' if delete else 'POST' if post else 'GET',
+                             query=query)
+            ret = self.get_snapshot().api(query, post, delete)
+            span.end(snapshot=True)
+            return ret
         if self.api_user is None or self.api_pass is None:
             return {'result': False,
                     'data': 'No API credentials provided.'}
 
         url = '{}{}{}'.format(self.api_url, self.api_ver, query)
         auth = (self.api_user, self.api_pass)
+        method = 'DELETE' if delete else 'POST' if post else 'GET'
+        span = self.span('api', method=method, query=query)
 
-        try:
-            verify = not self.opts.misc_insecure
-            if delete and post:
-                req = requests.delete(url, auth=auth, data=post, verify=verify)
-            elif delete:
-                req = requests.delete(url, auth=auth, verify=verify)
-            elif post:
-                req = requests.post(url, auth=auth, data=post, verify=verify)
-            else:
-                req = requests.get(url, auth=auth, verify=verify)
-            code = req.status_code
-        except requests.exceptions.SSLError:
-            return {'result': False,
-                    'data': 'SSL error when connecting to server.'}
-        except:
-            return {'result': False,
-                    'data': 'Unable to connect to server.'}
+        # Serve GET requests from the cache if possible
+        cache = None
+        entry = None
+        headers = dict()
+        if self.cache and not post and not delete and records is None \
+                and self.cache.cacheable(query):
+            cache = self.cache
+            cache_key = '{}\n{}'.format(self.api_user, url)
+            entry = cache.get(query, cache_key)
+            if entry is not None:
+                if cache.fresh(entry):
+                    span.end(cache='hit')
+                    return {'result': True,
+                            'data': entry['data'],
+                            'code': 200}
+                headers = cache.validators(entry)
+
+        session = self.get_session()
+        opened = self._connections(session, url)
+        span.mark('session')
+        attempt = 0
+        while True:
+            started = self.throttle.acquire()
+            span.mark('throttle')
+            try:
+                verify = not self.opts.misc_insecure
+                # When tracing, stop at the headers so the download is timed apart
+                stream = self.trace is not None or records is not None
+                kwargs = {'auth': auth, 'verify': verify, 'stream': stream, 'timeout': self.timeout}
+                if delete and post:
+                    req = session.delete(url, data=post, **kwargs)
+                elif delete:
+                    req = session.delete(url, **kwargs)
+                elif post:
+                    req = session.post(url, data=post, **kwargs)
+                else:
+                    req = session.get(url, headers=headers, **kwargs)
+                code = req.status_code
+                span.mark('wait')
+                size = None
+                wire = None
+                # Streamed records are downloaded as the caller reads them
+                if records is None or not req.ok:
+                    size = len(req.content)
+                    # Bytes as the server sent them, before gzip/deflate is undone
+                    wire = req.raw.tell() if hasattr(req.raw, 'tell') else None
+                    self.add_transfer(size, wire)
+                    span.mark('download')
+                # Connect time is part of the wait phase when this is true
+                span.set(new_connection=self._connections(session, url) != opened)
+            except requests.exceptions.SSLError:
+                self.throttle.release(started)
+                span.end(error='ssl')
+                return {'result': False,
+                        'data': 'SSL error when connecting to server.'}
+            except (requests.exceptions.Timeout, requests.exceptions.ConnectionError):
+                self.throttle.release(started, overloaded=True)
+                # A write may have been applied; only reads are safe to repeat
+                if method == 'GET' and attempt < self.max_retries:
+                    time.sleep(retry_after(None, attempt))
+                    attempt += 1
+                    continue
+                span.end(error='connect', retries=attempt)
+                return {'result': False,
+                        'data': 'Unable to connect to server.'}
+            except:
+                self.throttle.release(started)
+                span.end(error='connect')
+                return {'result': False,
+                        'data': 'Unable to connect to server.'}
+
+            busy = code in RETRY_STATUS
+            self.throttle.release(started, overloaded=busy)
+            # 429 and 503 mean the request was turned away, so writes may be repeated too
+            if busy and attempt < self.max_retries and (method == 'GET' or code in [429, 503]):
+                time.sleep(retry_after(req.headers.get('Retry-After'), attempt))
+                attempt += 1
+                continue
+            break
+        if attempt:
+            span.set(retries=attempt)
+
+        # Writes make cached reads of the same resource stale
+        if self.cache and (post or delete):
+            self.cache.invalidate(query)
+
+        # Cached copy is still current
+        if cache and entry is not None and code == 304:
+            cache.refresh(query, cache_key, entry)
+            span.end(status=code, cache='revalidated')
+            return {'result': True,
+                    'data': entry['data'],
+                    'code': 200}
 
         # Return API response
+        if req.ok and records is not None and not post and not delete:
+            def done(size, wire):
+                '''Counts the response and ends its span once it has been read.'''
+                self.add_transfer(size, wire)
+                span.mark('download')
+                span.end(status=code, streamed=True, bytes=size, wire_bytes=wire)
+            return {'result': True,
+                    'data': D42JsonStream(req, records, done),
+                    'code': code}
         if req.ok:
+            try:
+                data = decode_json(req.content)
+            except ValueError as e:
+                span.end(status=code, bytes=size, wire_bytes=wire, error='decode')
+                return {'result': False,
+                        'data': {'error_message': 'Unable to decode response: {}'.format(e)}}
+            span.mark('decode')
+            if cache:
+                cache.put(query, cache_key, data,
+                          req.headers.get('ETag'), req.headers.get('Last-Modified'))
+            span.end(status=code, bytes=size, wire_bytes=wire)
             return {'result': True,
-                    'data': strip_unicode(req.json()),
+                    'data': data,
                     'code': code}
 
         # Process error code (non-digit)
@@ -153,16 +457,239 @@ class D42(object):
         # Process server response
         message = getattr(req, 'text', '')
         if len(message) != 0:
-            err['server_response'] = strip_unicode(req.json())
+            try:
+                err['server_response'] = decode_json(req.content)
+            except ValueError:
+                err['server_response'] = message
 
         # Return error to caller
+        span.end(status=code, bytes=size, wire_bytes=wire)
         return {'result': False,
                 'data': err}
 
 
-    def out(self, data, fmt=None):
-        '''Print output in a pretty way.'''
-        self.outputter.render(data, fmt)
+    def api_many(self, calls):
+        '''Performs several API queries and returns their results in order.
+        Each call is a query string or a tuple of api() arguments. With the
+        pool engine, up to pool_size calls share the session at once.'''
+        calls = [c if isinstance(c, tuple) else (c,) for c in calls]
+        if self.engine != 'pool' or len(calls) < 2:
+            return [self.api(*c) for c in calls]
+
+        results = [None] * len(calls)
+        for num, ret in pool_map(lambda n: self.api(*calls[n]),
+                                 range(len(calls)), self.pool_size):
+            if isinstance(ret, BaseException):
+                ret = {'result': False,
+                       'data': 'Unexpected error: {}'.format(ret)}
+            results[num] = ret
+        return results
+
+
+    def search(self, query, key, params=None, page_size=None, fields=None):
+        '''Performs a search query and returns the results.
+        If paging is enabled, the returned data is a generator yielding the
+        records found under key, fetching one page at a time as needed.
+        page_size overrides the configured page size. Records only keep the
+        given fields, which the server is asked for when it supports that.'''
+        if params is None:
+            params = dict()
+        if page_size is None:
+            page_size = self.page_size
+        if fields and query in INCLUDE_COLS:
+            params = dict(params, include_cols=','.join(fields))
+
+        records = key if self.stream else None
+
+        if not page_size:
+            ret = self.api('{}?{}'.format(query, encode(params)), records=records)
+            if ret['result'] and isinstance(ret['data'], D42JsonStream):
+                ret['data'] = self._streamed(ret['data'], fields)
+                return ret
+            if fields and ret['result'] and isinstance(ret['data'], dict) \
+                    and isinstance(ret['data'].get(key), list):
+                ret['data'][key] = [self.project(r, fields) for r in ret['data'][key]]
+            return ret
+
+        params = dict(params)
+        params['limit'] = page_size
+        params['offset'] = 0
+        ret = self.api('{}?{}'.format(query, encode(params)), records=records)
+        if not ret['result']:
+            return ret
+        if not isinstance(ret['data'], (dict, D42JsonStream)) \
+                or (isinstance(ret['data'], dict) and key not in ret['data']):
+            return {'result': False,
+                    'data': 'Unexpected response; no {} in results.'.format(key)}
+
+        ret['data'] = self._pages(query, key, params, ret['data'], fields)
+        return ret
+
+
+    def _pages(self, query, key, params, page, fields=None):
+        '''Yields records from a paginated search.
+        Only one page is held in memory at a time; with the pool engine and
+        a known total, pool_size pages are fetched at once instead.'''
+        records = key if self.stream else None
+        while True:
+            count = 0
+            if isinstance(page, D42JsonStream):
+                for record in self._streamed(page, fields):
+                    count += 1
+                    yield record
+                # Members after the records are only known once they are read
+                total = page.get('total_count')
+            else:
+                found = [self.project(r, fields) for r in page.get(key, [])]
+                total = page.get('total_count')
+                page = None
+                count = len(found)
+                for record in found:
+                    yield record
+                found = None
+            page = None
+
+            params['offset'] += count
+            if count < params['limit']:
+                return
+            if total is not None and params['offset'] >= int(total):
+                return
+            if self.engine == 'pool' and total is not None:
+                break
+
+            ret = self.api('{}?{}'.format(query, encode(params)), records=records)
+            if not ret['result']:
+                stderr('Failed to fetch page at offset {}: {}'.format(
+                    params['offset'], ret['data']), exit_status=12)
+            page = ret['data']
+
+        offsets = range(params['offset'], int(total), params['limit'])
+        for start in range(0, len(offsets), self.pool_size):
+            window = offsets[start:start + self.pool_size]
+            queries = [('{}?{}'.format(query, encode(dict(params, offset=o))), None, False, records)
+                       for o in window]
+            for offset, ret in zip(window, self.api_many(queries)):
+                if not ret['result']:
+                    stderr('Failed to fetch page at offset {}: {}'.format(
+                        offset, ret['data']), exit_status=12)
+                if isinstance(ret['data'], D42JsonStream):
+                    for record in self._streamed(ret['data'], fields):
+                        yield record
+                    continue
+                for record in ret['data'].get(key, []):
+                    yield self.project(record, fields)
+
+
+    def _streamed(self, stream, fields=None):
+        '''Yields the records of a D42JsonStream as they are parsed.'''
+        try:
+            for record in stream:
+                yield self.project(record, fields)
+        except ValueError as e:
+            stderr('Unable to parse response: {}'.format(e), exit_status=12)
+
+
+    def project(self, record, fields=None):
+        '''Returns a record with only the given fields; all of them if
+        fields is None. Fields the record does not have are left out.'''
+        if not fields or not isinstance(record, dict):
+            return record
+        return dict((f, record[f]) for f in fields if f in record)
+
+
+    def index(self, name, query, key, fields):
+        '''Returns a set holding, for every record of a collection, the
+        index_key() of the given fields. Only used in bulk mode, where one paged
+        fetch replaces a request per existence check. The set is built once
+        more than bulk_checks checks have been made, so a few checks do not
+        fetch a whole collection; None means no index is available (not bulk,
+        too few checks yet, or failed).'''
+        if not self.bulk:
+            return None
+        with self.index_lock:
+            if name not in self.indexes:
+                self.index_checks[name] = self.index_checks.get(name, 0) + 1
+                if self.index_checks[name] <= self.bulk_checks:
+                    return None
+                ret = self.search(query, key, {}, page_size=self.page_size or 1000)
+                if ret['result']:
+                    self.indexes[name] = set(self.index_key(*[r.get(f) for f in fields])
+                                             for r in ret['data'])
+                else:
+                    stderr('Unable to index {}; checking one at a time'.format(name), 'WARNING')
+                    self.indexes[name] = None
+            return self.indexes[name]
+
+
+    def index_key(self, *values):
+        '''Returns the key an index stores for these field values.'''
+        return tuple(v.encode('utf-8') if isinstance(v, unicode) else str(v) for v in values)
+
+
+    def index_add(self, name, *values):
+        '''Records that an object now exists in an index that was built.'''
+        if self.indexes.get(name) is not None:
+            self.indexes[name].add(self.index_key(*values))
+
+
+    def index_drop(self, name):
+        '''Forgets an index; it is rebuilt on next use.'''
+        with self.index_lock:
+            self.indexes.pop(name, None)
+
+
+    def workers(self):
+        '''Returns how many API calls bulk operations make at once
+        (--concurrency), growing the connection pool to match if the
+        session has not been made yet.'''
+        workers = self.opts.misc_concurrency
+        # Every worker needs its own pooled connection
+        if self.session is None and workers > self.pool_size:
+            self.pool_size = workers
+        return workers
+
+
+    def bulk_map(self, function, items):
+        '''Calls function on every item, workers() at a time.
+        Yields (item, result) pairs as they complete. If function raised,
+        the result is {'result': False, 'error': 'Unexpected error: ...'}.'''
+        for item, res in pool_map(function, items, self.workers()):
+            if isinstance(res, BaseException):
+                res = {'result': False, 'error': 'Unexpected error: {}'.format(res)}
+            yield item, res
+
+
+    def add_transfer(self, size, wire=None):
+        '''Counts the decoded and on the wire bytes of a response.'''
+        with self.transfer_lock:
+            self.transfer[0] += size
+            self.transfer[1] += size if wire is None else wire
+
+
+    def transfer_summary(self):
+        '''Returns a line comparing bytes on the wire with bytes decoded,
+        or None if no response was counted.'''
+        decoded, wire = self.transfer
+        if not decoded:
+            return None
+        return 'bytes received {:d} on the wire, {:d} decoded ({:.0%})'.format(
+            wire, decoded, float(wire) / decoded)
+
+
+    def span(self, event, **fields):
+        '''Starts timing an event; does nothing unless tracing.'''
+        if self.trace is None:
+            return D42NullSpan()
+        return self.trace.span(event, **fields)
+
+
+    def out(self, data, fmt=None, whole=False):
+        '''Print output in a pretty way.
+        whole shows every column, ignoring --fields.'''
+        span = self.span('out', format=fmt or self.outputter.output_format)
+        self.outputter.render(data, fmt, whole)
+        span.mark('render')
+        span.end()
 
 
     def err(self, message, exit_status, blob=None):
@@ -171,4 +698,4 @@ class D42(object):
         The error produced is sent to stdout for processing by caller.
         Any call to err() will append an exit status to the running session.'''
         self.err_list.append(exit_status)
-        self.out({'error': message, 'exit_status': exit_status, 'blob': blob})
+        self.out({'error': message, 'exit_status': exit_status, 'blob': blob}, whole=True)
@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+'''
+Provides the D42Daemon class and the forward() client.
+A daemon keeps one warm process (loaded modules, pooled connections,
+caches) listening on a Unix socket; clients send it their arguments and
+environment and print what it sends back.
+
+Requests are one json line: {"argv": [...], "env": {...}, "cwd": "..."}
+Only D42_* and XDG_* variables are sent; the daemon keeps its own others.
+Replies are json lines: {"fd": 1|2, "data": "..."} then {"exit": N}
+Output that is not utf-8 (e.g. msgpack) is sent as {"fd": 1, "base64": "..."}
+
+This module is imported by the thin client, so it only uses the standard
+library and nothing else from lib/.
+
+Environment Variables Read :: D42_SOCKET, XDG_RUNTIME_DIR
+
+DEFINED EXIT :: none
+'''
+import os
+import sys
+import json
+import stat
+import base64
+import signal
+import socket
+
+# Environment variables sent to the daemon, by prefix
+FORWARD_ENV = ('D42_', 'XDG_')
+
+
+def socket_path():
+    '''Returns where the daemon listens: env[D42_SOCKET], or a per-user
+    socket in XDG_RUNTIME_DIR (or /tmp).'''
+    if os.environ.get('D42_SOCKET'):
+        return os.environ['D42_SOCKET']
+    base = os.environ.get('XDG_RUNTIME_DIR')
+    if base:
+        return os.path.join(base, 'd42-cli.sock')
+    return '/tmp/d42-cli-{}.sock'.format(os.getuid())
+
+
+def own_socket(path):
+    '''Returns True if path is a socket owned by this user.'''
+    try:
+        info = os.lstat(path)
+    except OSError:
+        return False
+    return stat.S_ISSOCK(info.st_mode) and info.st_uid == os.getuid()
+
+
+def forward(path, argv):
+    '''Runs a request in the daemon at path, copying its output to ours.
+    Returns the exit status, or None if no daemon answered.
+    Nothing is sent unless path is a socket owned by this user, since the
+    request carries credentials.'''
+    if not own_socket(path):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error:
+        sock.close()
+        return None
+
+    env = dict((k, v) for k, v in os.environ.items() if k.startswith(FORWARD_ENV))
+    request = {'argv': argv, 'env': env, 'cwd': os.getcwd()}
+    sock.sendall(json.dumps(request) + '\n')
+    status = None
+    streams = {1: sys.stdout, 2: sys.stderr}
+    for line in sock.makefile('r'):
+        frame = json.loads(line)
+        if 'exit' in frame:
+            status = frame['exit']
+            break
+        stream = streams[frame['fd']]
+        if 'base64' in frame:
+            stream.write(base64.b64decode(frame['base64']))
+        else:
+            stream.write(frame['data'].encode('utf-8'))
+        stream.flush()
+    sock.close()
+    # The daemon went away mid-request
+    return 9 if status is None else status
+
+
+class D42Terminated(Exception):
+    '''Raised in the daemon when it receives SIGTERM.'''
+
+
+def _terminate(signum, frame):
+    '''SIGTERM handler; unwinds the daemon so it cleans up its socket.'''
+    raise D42Terminated()
+
+
+class D42Stream(object):
+    '''File-like object that sends what is written as reply frames.'''
+
+    def __init__(self, conn, fd):
+        '''Class initialization'''
+        self.conn = conn
+        self.fd = fd
+
+
+    def write(self, data):
+        '''Sends data as a frame; bytes that are not utf-8 go as base64.'''
+        if isinstance(data, str):
+            try:
+                data = data.decode('utf-8')
+            except UnicodeDecodeError:
+                frame = {'fd': self.fd, 'base64': base64.b64encode(data)}
+                self.conn.sendall(json.dumps(frame) + '\n')
+                return
+        if data:
+            self.conn.sendall(json.dumps({'fd': self.fd, 'data': data}) + '\n')
+
+
+    def flush(self):
+        '''Nothing to do; every write is sent at once.'''
+        pass
+
+
+    def isatty(self):
+        '''The client's output is never treated as a terminal.'''
+        return False
+
+
+class D42Daemon(object):
+    '''Serves requests on a Unix socket, one at a time.
+    handler(argv) runs a request in this process and returns its exit status;
+    it sees the client's environment, working directory and output.'''
+    path = None
+    handler = None
+    sock = None
+
+
+    def __init__(self, path, handler):
+        '''Class initialization'''
+        self.path = path
+        self.handler = handler
+
+
+    def listen(self):
+        '''Binds the socket; only this user may connect.
+        Returns False if another daemon is already listening.
+        Raises OSError if something other than our own socket is in the way.'''
+        if os.path.lexists(self.path):
+            if not own_socket(self.path):
+                raise OSError('{} exists and is not a socket owned by this user'.format(self.path))
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.path)
+                probe.close()
+                return False
+            except socket.error:
+                # Left behind by a daemon that did not exit cleanly
+                os.remove(self.path)
+
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0o077)
+        try:
+            self.sock.bind(self.path)
+        finally:
+            os.umask(umask)
+        self.sock.listen(16)
+        return True
+
+
+    def serve(self):
+        '''Answers requests until interrupted or terminated.'''
+        signal.signal(signal.SIGTERM, _terminate)
+        try:
+            while True:
+                conn, _ = self.sock.accept()
+                try:
+                    self.request(conn)
+                except socket.error:
+                    # Client went away
+                    pass
+                finally:
+                    conn.close()
+        except (KeyboardInterrupt, D42Terminated):
+            pass
+        finally:
+            self.sock.close()
+            os.remove(self.path)
+
+
+    def request(self, conn):
+        '''Runs one request with the client's environment and output.'''
+        line = conn.makefile('r').readline()
+        try:
+            request = json.loads(line)
+            argv = [a.encode('utf-8') for a in request['argv']]
+            env = dict((k.encode('utf-8'), v.encode('utf-8'))
+                       for k, v in request['env'].items())
+            cwd = request['cwd']
+        except (ValueError, KeyError, TypeError, AttributeError):
+            conn.sendall(json.dumps({'fd': 2, 'data': 'CRITICAL: Bad request to daemon\n'}) + '\n')
+            conn.sendall(json.dumps({'exit': 2}) + '\n')
+            return
+
+        saved = (dict(os.environ), os.getcwd(), sys.stdin, sys.stdout, sys.stderr)
+        status = 9
+        try:
+            # The client's D42_* and XDG_* variables replace ours
+            for name in [k for k in os.environ if k.startswith(FORWARD_ENV)]:
+                del os.environ[name]
+            os.environ.update(env)
+            os.chdir(cwd)
+            # Prompts read end of file and are declined; use --yes
+            sys.stdin = open(os.devnull)
+            sys.stdout = D42Stream(conn, 1)
+            sys.stderr = D42Stream(conn, 2)
+            status = self.handler(argv)
+        except SystemExit as e:
+            status = e.code if isinstance(e.code, int) else 0 if e.code is None else 1
+        except (socket.error, D42Terminated):
+            raise
+        except Exception as e:
+            sys.stderr.write('CRITICAL: Request failed in daemon: {}\n'.format(e))
+        finally:
+            sys.stdin.close()
+            env, cwd, sys.stdin, sys.stdout, sys.stderr = saved
+            os.environ.clear()
+            os.environ.update(env)
+            os.chdir(cwd)
+        conn.sendall(json.dumps({'exit': status}) + '\n')
@@ -2,23 +2,32 @@
 '''
 Provides the D42Opts class.
 
-Environment Variables Read :: D42_URL, D42_USER, D42_PASS
+Environment Variables Read :: D42_URL, D42_USER, D42_PASS, D42_CACHE_TTL
 
 DEFINED EXIT :: none
 '''
 import argparse
+import json
 import os
 
-from util import stderr
+from util import stderr, decode_json
+
+# Argument types that can be stored in the manifest
+TYPES = {'int': int, 'float': float, 'str': str}
 
 class D42Opts(object):
     '''Master object to handle extra options loaded modules may provide'''
     parser = None
     groups = None
+    operations = None   # Maps operation flags to operation names
+    recorded = None     # Options added by each module, for the manifest
 
     def __init__(self, outputs=None):
         '''Class initialization'''
         self.groups = dict()
+        self.operations = dict()
+        self.recorded = dict()
+        self._module = None
 
         if not isinstance(outputs, list):
             stderr('Outputs passed to D42Opts.__init__ was not type list.', 'WARNING')
@@ -56,13 +65,96 @@ class D42Opts(object):
             help='D42 Password; reads env[D42_API_PASS]',
             default=os.environ.get('D42_API_PASS'))
 
+        self.parser.add_argument(
+            '--pool-size',
+            dest='d42_pool_size',
+            action='store',
+            type=int,
+            metavar='10',
+            help='Maximum pooled connections to the D42 application; def=10')
+        self.parser.add_argument(
+            '--engine',
+            dest='d42_engine',
+            action='store',
+            choices=['serial', 'pool'],
+            help='How bulk API calls run: one at a time, or up to --pool-size at once; def=serial')
+        self.parser.add_argument(
+            '--rate-limit',
+            dest='d42_rate_limit',
+            action='store',
+            type=float,
+            metavar='20',
+            help='Start at most this many API requests per second')
+        self.parser.add_argument(
+            '--max-retries',
+            dest='d42_max_retries',
+            action='store',
+            type=int,
+            metavar='3',
+            help='Retry requests answered with 429/5xx or timed out; def=3')
+        self.parser.add_argument(
+            '--timeout',
+            dest='d42_timeout',
+            action='store',
+            type=float,
+            metavar='60',
+            help='Seconds to wait for the D42 application to respond')
+
+        self.parser.add_argument(
+            '--page-size',
+            dest='d42_page_size',
+            action='store',
+            type=int,
+            metavar='1000',
+            help='Fetch searches in pages of this many records; streams results')
+        self.parser.add_argument(
+            '--stream',
+            dest='d42_stream',
+            action='store_true',
+            help='Parse search results as they download instead of all at once')
+        self.parser.add_argument(
+            '--fields',
+            dest='d42_fields',
+            action='store',
+            metavar='name,serial_no',
+            help='Only keep these fields of each record returned')
+
+        self.parser.add_argument(
+            '--cache-ttl',
+            dest='d42_cache_ttl',
+            action='store',
+            type=int,
+            metavar='300',
+            help='Cache GET responses on disk for this many seconds; reads env[D42_CACHE_TTL]',
+            default=os.environ.get('D42_CACHE_TTL'))
+        self.parser.add_argument(
+            '--no-cache',
+            dest='d42_no_cache',
+            action='store_true',
+            help='Neither read nor write the response cache')
+        self.parser.add_argument(
+            '--offline',
+            dest='d42_offline',
+            action='store_true',
+            help='Answer searches and lookups from the local snapshot (see --sync)')
+
+        self.parser.add_argument(
+            '--trace',
+            dest='d42_trace',
+            action='store',
+            nargs='?',
+            const='-',
+            metavar='FILE',
+            help='Write per-call timings as json lines to FILE (def=stderr)')
+
         # Optional Parameters
         self.parser.add_argument(
             '--params',
             dest='d42_params',
             action='store',
             metavar='\'{"foo": "bar"}\'',
-            help='Parameters available to operation; json')
+            help='Parameters available to operation; json, or @FILE (@- for stdin) '
+                 'holding json or msgpack')
         self.parser.add_argument(
             '--prm', '-p',
             dest='d42_prm',
@@ -70,6 +162,27 @@ class D42Opts(object):
             metavar='k=v',
             help='Single k=v parameters; supersedes --params')
 
+        # Batch execution
+        self.parser.add_argument(
+            '--batch',
+            dest='d42_batch',
+            action='store',
+            metavar='FILE|-',
+            help='Run one json operation per line, e.g. {"operation": "get-device", '
+                 '"params": {...}}, or a stream of msgpack maps; combine with --yes '
+                 'when reading stdin')
+
+        # Resident process
+        self.parser.add_argument(
+            '--daemon',
+            dest='d42_daemon',
+            action='store',
+            nargs='?',
+            const='-',
+            metavar='SOCKET',
+            help='Serve requests on a Unix socket (def=env[D42_SOCKET]); '
+                 'clients forward to it when D42_SOCKET is set')
+
         # Output formats
         self.parser.add_argument(
             '--out',
@@ -102,6 +215,11 @@ class D42Opts(object):
         Modules are only allowed to work with option groups'''
         self._need_group(group)
         self.groups[group].add_argument(*args, **kwargs)
+        if group == 'operations' and kwargs.get('const'):
+            for flag in args:
+                self.operations[flag.lstrip('-')] = kwargs['const']
+        if self._module is not None:
+            self.recorded[self._module].append([group, list(args), kwargs])
 
 
     def load_module_options(self, d42):
@@ -116,9 +234,71 @@ class D42Opts(object):
 
             if not hasattr(mod, 'modhook_options'):
                 continue
+            self._module = modname
+            self.recorded[modname] = list()
             mod.modhook_options(self)
+            self._module = None
+
+
+    def load_manifest(self, d42):
+        '''Adds module options from the manifest, without importing modules.
+        Returns False if the manifest is missing or older than any module.'''
+        try:
+            with open(d42.manifest) as fh:
+                manifest = decode_json(fh.read())
+        except (IOError, ValueError):
+            return False
+        if manifest.get('modules') != _module_stamps(d42):
+            return False
+
+        for modname, options in manifest.get('options', []):
+            for group, args, kwargs in options:
+                if 'type' in kwargs:
+                    kwargs['type'] = TYPES[kwargs['type']]
+                self.opt(group, *args, **kwargs)
+        return True
+
+
+    def save_manifest(self, d42):
+        '''Stores the options recorded by load_module_options().
+        Failing to write the manifest only costs startup time.'''
+        options = list()
+        for modname in d42.modules_loaded:
+            recorded = list()
+            for group, args, kwargs in self.recorded.get(modname, []):
+                kwargs = dict(kwargs)
+                if 'type' in kwargs:
+                    if kwargs['type'] not in TYPES.values():
+                        return False
+                    kwargs['type'] = kwargs['type'].__name__
+                recorded.append([group, args, kwargs])
+            options.append([modname, recorded])
+
+        manifest = {'modules': _module_stamps(d42), 'options': options}
+        tmp = '{}.{}.tmp'.format(d42.manifest, os.getpid())
+        try:
+            with open(tmp, 'w') as fh:
+                json.dump(manifest, fh, indent=1)
+            os.rename(tmp, d42.manifest)
+        except (IOError, OSError, TypeError, ValueError):
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return False
+        return True
 
 
     def parse_opts(self):
         '''Return parsed options'''
         return self.parser.parse_args()
+
+
+def _module_stamps(d42):
+    '''Returns the modification time of each module in mods_list.'''
+    stamps = dict()
+    for nam in d42.mods_list or []:
+        path = os.path.join(*nam.split('.')) + '.py'
+        try:
+            stamps[nam] = os.stat(path).st_mtime
+        except OSError:
+            stamps[nam] = None
+    return stamps
@@ -5,17 +5,27 @@ It prints pretty things to stdout.
 
 DEFINED EXIT :: 31, 32
 '''
+import csv
+import imp
+import sys
 import time
 import json
+import types
 import pprint
+import itertools
 
 from util import stderr
 
+# Rows read before a table is printed; they decide the column widths
+TABLE_SAMPLE = 100
+
 
 class D42Output(object):
     '''Object to handle outputting to various formats.'''
     outputs = None
+    libraries = ['yaml', 'msgpack'] # Optional libraries; imported when first used
     output_format = 'pprint' # default
+    columns = None           # Columns for csv, tsv and table; def=keys of the first record
 
 
     def __init__(self):
@@ -31,14 +41,16 @@ class D42Output(object):
         # Required Outputters ; libs already loaded
         # d42-cli will not run without json
         # pprint is the easiest to test/debug/skim and is the default
-        outputs = ['json', 'pprint', 'devnull', 'raw']
+        outputs = ['json', 'ndjson', 'pprint', 'devnull', 'raw', 'csv', 'tsv', 'table']
 
-        # Attempt to load additional outputters
-        for lib in ['yaml']:
+        # Register additional outputters whose library can be found
+        for lib in self.libraries:
             try:
-                library = __import__(lib)
-                globals()[lib] = library
+                imp.find_module(lib)
                 outputs.append(lib)
+            except ImportError:
+                # Not installed; the outputter is not offered
+                pass
             except:
                 # No reason to stop loading, but drop something on stderr
                 # This should only be reached if there is a bug in this file
@@ -47,6 +59,12 @@ class D42Output(object):
         self.outputs = outputs
 
 
+    def load_library(self, lib):
+        '''Import a library registered by load_libraries().'''
+        if lib in self.libraries and lib not in globals():
+            globals()[lib] = __import__(lib)
+
+
     def set_format(self, fmt):
         '''Set the selected output option.'''
         if not fmt in self.outputs:
@@ -56,8 +74,9 @@ class D42Output(object):
         self.output_format = fmt
 
 
-    def render(self, data, fmt=None):
-        '''Render the reousted output using the requested format'''
+    def render(self, data, fmt=None, whole=False):
+        '''Render the reousted output using the requested format
+        whole renders every column, whatever columns is set to.'''
         if not fmt:
             fmt = self.output_format
 
@@ -71,12 +90,80 @@ class D42Output(object):
             # than revert to a default to get data out, we should die here.
             stderr('Requested outputter unavailable', exit_status=31)
 
+        columns = self.columns
+        if whole:
+            self.columns = None
         try:
-            rndr = getattr(self, '_print_{}'.format(fmt))
+            self.load_library(fmt)
+            if isinstance(data, types.GeneratorType):
+                # Paged results; stream them if the outputter knows how
+                if hasattr(self, '_stream_{}'.format(fmt)):
+                    rndr = getattr(self, '_stream_{}'.format(fmt))
+                else:
+                    data = list(data)
+                    rndr = getattr(self, '_print_{}'.format(fmt))
+            else:
+                rndr = getattr(self, '_print_{}'.format(fmt))
             rndr(data)
+        except SystemExit:
+            # A generator may give up part-way through; keep its exit status
+            raise
         except:
             # Same as above; an error here should result in death.
             stderr('Unable to render data with requested outputter.', exit_status=31)
+        finally:
+            self.columns = columns
+
+
+    def _records(self, data):
+        '''Returns the records held in data.
+        A search result ({'ips': [...], 'total_count': N}) yields its inner
+        list; any other list yields its items; anything else is one record.'''
+        if isinstance(data, dict):
+            lists = [k for k, v in data.items() if isinstance(v, list)]
+            extra = set(data) - set(lists)
+            if len(lists) == 1 and extra <= set(['total_count', 'limit', 'offset']):
+                return data[lists[0]]
+        if isinstance(data, list):
+            return data
+        return [data]
+
+
+    def _columns(self, records):
+        '''Returns the columns of a tabular outputter: self.columns if set
+        and the records have any of them, otherwise every key of the given
+        records, sorted.'''
+        keys = set()
+        for record in records:
+            keys.update(record if isinstance(record, dict) else ['value'])
+        if self.columns and keys.intersection(self.columns):
+            return self.columns
+        return sorted(keys)
+
+
+    def _row(self, record, columns):
+        '''Returns the cells of one record as strings.
+        Missing fields are blank and nested values are written as json.'''
+        if not isinstance(record, dict):
+            record = {'value': record}
+        row = []
+        for col in columns:
+            value = record.get(col)
+            if value is None:
+                value = ''
+            elif isinstance(value, (dict, list)):
+                value = json.dumps(value)
+            elif isinstance(value, unicode):
+                value = value.encode('utf-8')
+            else:
+                value = str(value)
+            row.append(value)
+        return row
+
+
+    def _width(self, cell):
+        '''Returns the number of characters in a utf-8 cell.'''
+        return len(cell.decode('utf-8', 'replace'))
 
 
     ##
@@ -90,11 +177,23 @@ class D42Output(object):
         print(json.dumps(data))
 
 
+    def _print_ndjson(self, data):
+        '''Render the output as json, one record per line.
+        Search results are split into the records they wrap.'''
+        self._stream_ndjson(self._records(data))
+
+
     def _print_yaml(self, data):
         '''Render the output using yaml.'''
         print(yaml.dump(data, default_flow_style=False))
 
 
+    def _print_msgpack(self, data):
+        '''Render the output as msgpack, one object per record.
+        Search results are split into the records they wrap.'''
+        self._stream_msgpack(self._records(data))
+
+
     def _print_pprint(self, data):
         '''Render the output using pprint.'''
         pprint.pprint(data)
@@ -109,6 +208,132 @@ class D42Output(object):
         '''Render nothing'''
         pass
 
+
+    def _print_csv(self, data):
+        '''Render records as csv with a header row.'''
+        self._stream_csv(self._records(data))
+
+
+    def _print_tsv(self, data):
+        '''Render records as tab separated values with a header row.'''
+        self._stream_tsv(self._records(data))
+
+
+    def _print_table(self, data):
+        '''Render records as a table with aligned columns.'''
+        self._stream_table(self._records(data))
+
+
+    ##
+    # Stream functions for outputters.
+    #   Optional; receive a generator of records and print them as they arrive.
+    #   Outputters without one are given the fully collected list instead.
+    ##
+
+
+    def _stream_json(self, data):
+        '''Render records as a json list, one record at a time.'''
+        sep = ''
+        sys.stdout.write('[')
+        for record in data:
+            sys.stdout.write(sep + json.dumps(record))
+            sys.stdout.flush()
+            sep = ', '
+        sys.stdout.write(']\n')
+
+
+    def _stream_ndjson(self, data):
+        '''Render records as json, one record per line as they arrive.'''
+        for record in data:
+            sys.stdout.write(json.dumps(record) + '\n')
+            sys.stdout.flush()
+
+
+    def _stream_yaml(self, data):
+        '''Render records as a yaml list, one record at a time.'''
+        for record in data:
+            sys.stdout.write(yaml.dump([record], default_flow_style=False))
+            sys.stdout.flush()
+
+
+    def _stream_msgpack(self, data):
+        '''Render records as msgpack objects, one after another as they
+        arrive. Strings are packed as the msgpack str type.'''
+        for record in data:
+            sys.stdout.write(msgpack.packb(record, use_bin_type=False))
+            sys.stdout.flush()
+
+
+    def _stream_pprint(self, data):
+        '''Render records using pprint, one record at a time.'''
+        for record in data:
+            pprint.pprint(record)
+            sys.stdout.flush()
+
+
+    def _stream_raw(self, data):
+        '''Render unformatted records, one record at a time.'''
+        for record in data:
+            print(record)
+            sys.stdout.flush()
+
+
+    def _stream_devnull(self, data):
+        '''Consume records and render nothing'''
+        for _ in data:
+            pass
+
+
+    def _stream_csv(self, data, delimiter=','):
+        '''Render records as csv, one row as each arrives.
+        Columns are taken from the first TABLE_SAMPLE records, as for
+        tables; keys that only appear later are dropped.'''
+        data = iter(data)
+        sample = list(itertools.islice(data, TABLE_SAMPLE))
+        if not sample:
+            return
+        columns = self._columns(sample)
+        writer = csv.writer(sys.stdout, delimiter=delimiter, lineterminator='\n')
+        writer.writerow(columns)
+        for record in itertools.chain(sample, data):
+            writer.writerow(self._row(record, columns))
+            sys.stdout.flush()
+
+
+    def _stream_tsv(self, data):
+        '''Render records as tab separated values, one row as each arrives.'''
+        self._stream_csv(data, delimiter='\t')
+
+
+    def _stream_table(self, data):
+        '''Render records as a table, one row as each arrives.
+        Columns and their widths come from the first TABLE_SAMPLE records;
+        wider values in later rows push the rest of their row over.'''
+        data = iter(data)
+        sample = list(itertools.islice(data, TABLE_SAMPLE))
+        if not sample:
+            return
+        columns = self._columns(sample)
+        rows = [self._row(record, columns) for record in sample]
+        widths = [max([len(col)] + [self._width(row[i]) for row in rows])
+                  for i, col in enumerate(columns)]
+
+        def line(cells):
+            '''Writes one row, padding each cell to its column width.'''
+            padded = [cell + ' ' * (width - self._width(cell))
+                      for cell, width in zip(cells, widths)]
+            sys.stdout.write('  '.join(padded).rstrip() + '\n')
+
+        line(columns)
+        line(['-' * width for width in widths])
+        for row in rows:
+            line(row)
+        sys.stdout.flush()
+        for record in data:
+            line(self._row(record, columns))
+            sys.stdout.flush()
+
+
     def _print_secret(self, data):
         '''Render plain output and then clear the screen'''
         try:
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+'''
+Provides the D42PrefixTree class.
+It indexes IPv4 and IPv6 networks in a binary trie so containment, longest
+prefix match and overlap queries take time proportional to the prefix
+length rather than the number of networks.
+
+DEFINED EXIT :: none
+'''
+import socket
+import binascii
+
+# Address family => bits in an address
+FAMILIES = {socket.AF_INET: 32, socket.AF_INET6: 128}
+
+
+def parse_address(text):
+    '''Returns (family, integer) for an IPv4 or IPv6 address.
+    Raises ValueError if the text is not an address.'''
+    text = text.strip()
+    for family in FAMILIES:
+        try:
+            packed = socket.inet_pton(family, text)
+        except (socket.error, ValueError):
+            continue
+        return family, int(binascii.hexlify(packed), 16)
+    raise ValueError('Not an IP address: {}'.format(text))
+
+
+def format_address(family, value):
+    '''Returns the text form of an address from parse_address().'''
+    packed = binascii.unhexlify('{:0{}x}'.format(value, FAMILIES[family] // 4))
+    return socket.inet_ntop(family, packed)
+
+
+def parse_network(network, mask_bits=None):
+    '''Returns (family, integer, mask_bits) for a network.
+    The mask may be given separately or as "address/bits"; an address
+    without a mask is a single host. Host bits are cleared.'''
+    network = str(network)
+    if mask_bits is None and '/' in network:
+        network, mask_bits = network.split('/', 1)
+    family, value = parse_address(network)
+    width = FAMILIES[family]
+    if mask_bits is None or mask_bits == '':
+        mask_bits = width
+    mask_bits = int(mask_bits)
+    if not 0 <= mask_bits <= width:
+        raise ValueError('Invalid mask length: {}'.format(mask_bits))
+    value &= ~((1 << (width - mask_bits)) - 1)
+    return family, value, mask_bits
+
+
+def host_range(network, mask_bits=None):
+    '''Returns (family, first, last) host addresses of a network as integers.
+    The network and broadcast addresses of IPv4 networks shorter than /31
+    are not hosts.'''
+    family, first, mask_bits = parse_network(network, mask_bits)
+    last = first | ((1 << (FAMILIES[family] - mask_bits)) - 1)
+    if family == socket.AF_INET and mask_bits < 31:
+        first += 1
+        last -= 1
+    return family, first, last
+
+
+class D42PrefixTree(object):
+    '''Binary trie of networks. Each node is [zero, one, values].'''
+    roots = None    # Address family => root node
+    size = 0        # Number of networks inserted
+
+
+    def __init__(self):
+        '''Class initialization'''
+        self.roots = dict((f, [None, None, None]) for f in FAMILIES)
+        self.size = 0
+
+
+    def insert(self, network, mask_bits, value):
+        '''Adds a network; several values may share one network.'''
+        family, bits, length = parse_network(network, mask_bits)
+        width = FAMILIES[family]
+        node = self.roots[family]
+        for i in range(length):
+            branch = (bits >> (width - 1 - i)) & 1
+            if node[branch] is None:
+                node[branch] = [None, None, None]
+            node = node[branch]
+        if node[2] is None:
+            node[2] = []
+        node[2].append(value)
+        self.size += 1
+
+
+    def _path(self, family, bits, length):
+        '''Yields (depth, node) for each node on the way to a prefix.'''
+        width = FAMILIES[family]
+        node = self.roots[family]
+        yield 0, node
+        for i in range(length):
+            node = node[(bits >> (width - 1 - i)) & 1]
+            if node is None:
+                return
+            yield i + 1, node
+
+
+    def containing(self, network, mask_bits=None):
+        '''Returns values of every network containing the given network or
+        address, most specific first.'''
+        family, bits, length = parse_network(network, mask_bits)
+        found = []
+        for _, node in self._path(family, bits, length):
+            if node[2]:
+                found.extend(node[2])
+        found.reverse()
+        return found
+
+
+    def longest(self, network, mask_bits=None):
+        '''Returns the values of the most specific network containing the
+        given network or address, or an empty list.'''
+        family, bits, length = parse_network(network, mask_bits)
+        best = []
+        for _, node in self._path(family, bits, length):
+            if node[2]:
+                best = node[2]
+        return list(best)
+
+
+    def overlapping(self, network, mask_bits=None):
+        '''Returns values of every network that contains, or is contained
+        by, the given network.'''
+        family, bits, length = parse_network(network, mask_bits)
+        found = []
+        last = None
+        for depth, node in self._path(family, bits, length):
+            if node[2]:
+                found.extend(node[2])
+            last = (depth, node)
+        if last is None or last[0] != length:
+            return found
+
+        # Everything below the prefix itself is contained by it
+        stack = [last[1][1], last[1][0]]
+        while stack:
+            node = stack.pop()
+            if node is None:
+                continue
+            if node[2]:
+                found.extend(node[2])
+            stack.append(node[1])
+            stack.append(node[0])
+        return found
@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+'''
+Provides the D42Snapshot class.
+It keeps a local SQLite copy of devices, ips, subnets and vlans so that
+searches and lookups can be answered without asking the server.
+
+Environment Variables Read :: XDG_CACHE_HOME
+
+DEFINED EXIT :: none
+'''
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import urllib
+import threading
+import urlparse
+
+from util import decode_json, compress, decompress
+
+
+# Name => how to fetch a table and which fields are indexed columns
+TABLES = {
+    'devices': {'query': '/devices/all/', 'key': 'Devices', 'id': 'device_id',
+                'columns': ['name', 'serial_no', 'type']},
+    'ips': {'query': '/ips/', 'key': 'ips', 'id': 'id',
+            'columns': ['ip', 'subnet_id', 'subnet', 'device', 'available']},
+    'subnets': {'query': '/subnets/', 'key': 'subnets', 'id': 'subnet_id',
+                'columns': ['network', 'mask_bits', 'name']},
+    'vlans': {'query': '/vlans/', 'key': 'vlans', 'id': 'vlan_id',
+              'columns': ['number', 'name']},
+}
+
+# Searches on these columns match substrings, as the server does
+CONTAINS = {'devices': ['name']}
+
+# Records fetched before each write to the database
+BATCH = 500
+
+# Bumped when stored data changes format; older snapshots are rebuilt
+SCHEMA = 1
+
+
+class D42Snapshot(object):
+    '''Local SQLite copy of the D42 inventory.'''
+    path = None
+    conn = None
+
+
+    def __init__(self, api_url, path=None):
+        '''Class initialization'''
+        if path is None:
+            base = os.environ.get('XDG_CACHE_HOME',
+                                  os.path.join(os.path.expanduser('~'), '.cache'))
+            digest = hashlib.sha1(api_url.encode('utf-8')).hexdigest()[:12]
+            path = os.path.join(base, 'd42-cli', 'snapshot-{}.db'.format(digest))
+        self.path = path
+        self.lock = threading.Lock()
+
+
+    def connect(self):
+        '''Opens (and if needed creates) the database.'''
+        if self.conn is not None:
+            return self.conn
+        folder = os.path.dirname(self.path)
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder, 0o700)
+        if not os.path.exists(self.path):
+            os.close(os.open(self.path, os.O_WRONLY | os.O_CREAT, 0o600))
+
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.text_factory = str
+        if conn.execute('PRAGMA user_version').fetchone()[0] != SCHEMA:
+            conn.execute('DROP TABLE IF EXISTS meta')
+            for name in TABLES:
+                conn.execute('DROP TABLE IF EXISTS {}'.format(name))
+            conn.execute('PRAGMA user_version = {:d}'.format(SCHEMA))
+        conn.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, synced TEXT)')
+        for name, table in TABLES.items():
+            # data is the record as zlib compressed json
+            conn.execute('CREATE TABLE IF NOT EXISTS {} (id INTEGER PRIMARY KEY, {}, data BLOB)'.format(
+                name, ', '.join('{} TEXT'.format(c) for c in table['columns'])))
+            for column in table['columns']:
+                conn.execute('CREATE INDEX IF NOT EXISTS {0}_{1} ON {0} ({1})'.format(name, column))
+        conn.commit()
+        self.conn = conn
+        return conn
+
+
+    def synced(self, name):
+        '''Returns when a table was last synced, or None.'''
+        row = self.connect().execute(
+            'SELECT synced FROM meta WHERE name = ?', (name,)).fetchone()
+        return row[0] if row else None
+
+
+    def sync(self, d42, name, full=False, page_size=1000):
+        '''Fetches a table from the server into the snapshot.
+        Only records updated since the last sync are fetched unless full is
+        set or the table was never synced. Returns a summary dictionary.'''
+        table = TABLES[name]
+        conn = self.connect()
+        since = None if full else self.synced(name)
+        # Records changed while this sync runs are fetched again next time
+        started = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(time.time() - 60))
+
+        params = {'last_updated_gt': since} if since else {}
+        ret = d42.search(table['query'], table['key'], params, page_size=page_size)
+        if not ret['result'] and since:
+            # Endpoint does not support incremental fetches
+            since = None
+            ret = d42.search(table['query'], table['key'], page_size=page_size)
+        if not ret['result']:
+            return {'result': False, 'data': ret['data']}
+
+        with self.lock:
+            if not since:
+                conn.execute('DELETE FROM {}'.format(name))
+            count = 0
+            batch = []
+            for record in ret['data']:
+                batch.append(self._row(table, record))
+                if len(batch) >= BATCH:
+                    count += self._store(name, table, batch)
+                    batch = []
+            count += self._store(name, table, batch)
+            conn.execute('INSERT OR REPLACE INTO meta (name, synced) VALUES (?, ?)',
+                         (name, started))
+            conn.commit()
+        return {'result': True, 'mode': 'incremental' if since else 'full', 'records': count}
+
+
+    def _row(self, table, record):
+        '''Returns the database row for a record.'''
+        row = [record.get(table['id'])]
+        row.extend(None if record.get(c) is None else str(record[c]) for c in table['columns'])
+        row.append(sqlite3.Binary(compress(json.dumps(record, separators=(',', ':')))))
+        return row
+
+
+    def _store(self, name, table, rows):
+        '''Writes rows to a table, replacing records with the same id.'''
+        if rows:
+            self.conn.executemany('INSERT OR REPLACE INTO {} VALUES ({})'.format(
+                name, ', '.join('?' * (len(table['columns']) + 2))), rows)
+        return len(rows)
+
+
+    def api(self, query, post=None, delete=False):
+        '''Answers an API query from the snapshot.
+        Returns the same dictionary as D42.api().'''
+        if post or delete:
+            return {'result': False, 'data': 'Changes cannot be made offline.'}
+
+        url = urlparse.urlparse(query)
+        parts = [p for p in url.path.split('/') if p]
+        params = dict(urlparse.parse_qsl(url.query))
+        if not parts or parts[0] not in TABLES:
+            return {'result': False, 'data': 'Not available offline: {}'.format(query)}
+        name = parts[0]
+        rest = parts[1:]
+
+        with self.lock:
+            if self.synced(name) is None:
+                return {'result': False,
+                        'data': 'No offline copy of {}; run --sync first.'.format(name)}
+            if rest and rest != ['all']:
+                return self._get(name, rest)
+            return self._search(name, params)
+
+
+    def _get(self, name, rest):
+        '''Looks up a single record by id (or device name).'''
+        if name == 'devices' and len(rest) == 2 and rest[0] in ['id', 'name']:
+            column, value = ('id', rest[1]) if rest[0] == 'id' else ('name', urllib.unquote(rest[1]))
+        else:
+            column, value = 'id', rest[0]
+        row = self.conn.execute('SELECT data FROM {} WHERE {} = ?'.format(name, column),
+                                (value,)).fetchone()
+        if row is None:
+            return {'result': False,
+                    'data': {'error_message': 'Error accessing API (NOT FOUND)'}}
+        return {'result': True, 'data': decode_json(decompress(row[0])), 'code': 200}
+
+
+    def _search(self, name, params):
+        '''Searches a table; filters on indexed columns are done in SQL.'''
+        table = TABLES[name]
+        limit = params.pop('limit', None)
+        offset = int(params.pop('offset', 0) or 0)
+        params.pop('last_updated_gt', None)
+        params.pop('include_cols', None)
+
+        where = []
+        args = []
+        for key in list(params):
+            if key in table['columns']:
+                if key in CONTAINS.get(name, []):
+                    where.append('{} LIKE ?'.format(key))
+                    args.append('%{}%'.format(params.pop(key)))
+                else:
+                    where.append('{} = ?'.format(key))
+                    args.append(params.pop(key))
+        sql = 'SELECT data FROM {}{} ORDER BY id'.format(
+            name, ' WHERE ' + ' AND '.join(where) if where else '')
+
+        if params:
+            # Fields without a column; filter the decoded records
+            records = [decode_json(decompress(r[0])) for r in self.conn.execute(sql, args)]
+            records = [r for r in records
+                       if all(str(r.get(k)) == v for k, v in params.items())]
+            total = len(records)
+            end = offset + int(limit) if limit else None
+            return {'result': True, 'code': 200,
+                    'data': {table['key']: records[offset:end], 'total_count': total}}
+
+        total = self.conn.execute('SELECT COUNT(*) FROM ({})'.format(sql), args).fetchone()[0]
+        if limit:
+            sql += ' LIMIT {:d} OFFSET {:d}'.format(int(limit), offset)
+        # Stored records are json already; decode the whole page at once
+        rows = ','.join(decompress(r[0]) for r in self.conn.execute(sql, args))
+        data = decode_json('{{"{}": [{}], "total_count": {:d}}}'.format(table['key'], rows, total))
+        return {'result': True, 'data': data, 'code': 200}
+
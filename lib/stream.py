@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+'''
+Provides the D42JsonStream class.
+It parses a json response as it is downloaded, yielding the records of one
+array in the top-level object one at a time, so memory use is bounded by
+a record and a chunk rather than the whole response.
+
+DEFINED EXIT :: none
+'''
+import json
+import codecs
+
+from util import _strip_pairs
+
+# Bytes read from the response at a time
+CHUNK_SIZE = 65536
+
+# Characters json allows between tokens
+WHITESPACE = ' \t\n\r'
+
+# Characters that may follow a complete value
+DELIMITERS = WHITESPACE + ',:]}'
+
+
+class D42JsonStream(object):
+    '''Iterates over response[key] while the response is read.
+    Other top-level members are collected in meta; they are complete once
+    iteration ends. Raises ValueError if the response is not a json object.'''
+    key = None
+    meta = None             # Top-level members other than key
+    response = None         # requests response, read with stream=True
+    done = None             # Called with (bytes decoded, bytes on the wire) once read
+    size = 0                # Bytes read so far, after gzip/deflate is undone
+
+
+    def __init__(self, response, key, done=None):
+        '''Class initialization'''
+        self.response = response
+        self.key = key
+        self.done = done
+        self.meta = dict()
+        self._decoder = json.JSONDecoder(object_pairs_hook=_strip_pairs)
+        self._chunks = None
+        self._buf = u''
+        self._pos = 0
+        self._eof = False
+
+
+    def get(self, name, default=None):
+        '''Reads a top-level member, as with the decoded dictionary.'''
+        return self.meta.get(name, default)
+
+
+    def __iter__(self):
+        '''Yields the records of the keyed array; the response is closed
+        and done() called when iteration ends, however it ends.'''
+        try:
+            for record in self._parse():
+                yield record
+        finally:
+            if self.done is not None:
+                raw = self.response.raw
+                self.done(self.size, raw.tell() if hasattr(raw, 'tell') else None)
+            self.response.close()
+
+
+    def _fill(self):
+        '''Reads another chunk; returns False at the end of the response.'''
+        if self._eof:
+            return False
+        if self._chunks is None:
+            decoder = codecs.getincrementaldecoder('utf-8')()
+            self._chunks = (decoder.decode(c) for c in self._read())
+        # Drop what has been parsed so the buffer stays about one chunk long
+        self._buf = self._buf[self._pos:]
+        self._pos = 0
+        for chunk in self._chunks:
+            if chunk:
+                self._buf += chunk
+                return True
+        self._eof = True
+        return False
+
+
+    def _read(self):
+        '''Yields chunks of the response, counting their size.'''
+        for chunk in self.response.iter_content(CHUNK_SIZE):
+            self.size += len(chunk)
+            yield chunk
+
+
+    def _peek(self):
+        '''Skips whitespace and returns the next character ('' at the end).'''
+        while True:
+            while self._pos < len(self._buf) and self._buf[self._pos] in WHITESPACE:
+                self._pos += 1
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if not self._fill():
+                return ''
+
+
+    def _expect(self, chars):
+        '''Consumes the next character, which must be one of chars.'''
+        char = self._peek()
+        if not char or char not in chars:
+            raise ValueError('Expected {} at character {}, found {!r}'.format(
+                ' or '.join(chars), self._pos, char))
+        self._pos += 1
+        return char
+
+
+    def _value(self):
+        '''Decodes the next complete json value.'''
+        self._peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buf, self._pos)
+            except ValueError:
+                if self._fill():
+                    continue
+                raise
+            except RuntimeError:
+                # The decoder recurses into nested values
+                raise ValueError('json is nested too deeply to decode')
+            # A number cut off by the end of a chunk still decodes; only trust
+            # values followed by a delimiter
+            if (end == len(self._buf) or self._buf[end] not in DELIMITERS) and self._fill():
+                continue
+            self._pos = end
+            if isinstance(value, unicode):
+                value = value.encode('utf-8')
+            return value
+
+
+    def _parse(self):
+        '''Yields each record of the keyed array, storing other members.'''
+        self._expect('{')
+        if self._peek() == '}':
+            self._pos += 1
+            return
+        while True:
+            name = self._value()
+            self._expect(':')
+            if name == self.key and self._peek() == '[':
+                self._pos += 1
+                if self._peek() == ']':
+                    self._pos += 1
+                else:
+                    while True:
+                        yield self._value()
+                        if self._expect(',]') == ']':
+                            break
+            else:
+                self.meta[name] = self._value()
+            if self._expect(',}') == '}':
+                return
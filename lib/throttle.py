@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+'''
+Provides the D42Throttle class.
+It decides how many API requests may be in flight and how fast they may
+start, so bulk jobs run as fast as the server can take them.
+
+Concurrency follows AIMD: the limit grows by one after a window of
+requests with stable latency, and halves when the server answers 429 or
+5xx, or a request times out. An optional token bucket caps requests per
+second.
+
+DEFINED EXIT :: none
+'''
+import time
+import random
+import threading
+import email.utils
+
+# Status codes that mean the server is overloaded; the request may be retried
+RETRY_STATUS = [429, 502, 503, 504]
+
+# Latency this many times the best seen is no longer "stable"
+LATENCY_FACTOR = 2.0
+
+# Longest wait between retries, in seconds
+MAX_BACKOFF = 300
+
+
+def retry_after(value, attempt):
+    '''Returns seconds to wait before a retry.
+    Uses a Retry-After header (seconds or HTTP date) when given, otherwise
+    exponential backoff with jitter.'''
+    if value:
+        value = value.strip()
+        if value.isdigit():
+            return min(int(value), MAX_BACKOFF)
+        date = email.utils.parsedate_tz(value)
+        if date is not None:
+            return min(max(0, email.utils.mktime_tz(date) - time.time()), MAX_BACKOFF)
+    return min(0.5 * 2 ** attempt, MAX_BACKOFF) * random.uniform(0.5, 1.0)
+
+
+class D42Throttle(object):
+    '''Adaptive limit on concurrent requests, plus an optional rate limit.'''
+    limit = None            # Requests currently allowed in flight
+    max_limit = None        # Never allow more than this (the pool size)
+    rate = None             # Requests per second; None for no limit
+    active = 0              # Requests in flight
+    best = None             # Lowest latency seen, in seconds
+    tokens = 0.0            # Token bucket level
+    filled = None           # When the bucket was last topped up
+    decreased = 0.0         # When the limit was last cut
+    window = None           # Latencies since the limit last changed
+
+
+    def __init__(self, max_limit, rate=None):
+        '''Class initialization'''
+        self.max_limit = max(1, max_limit)
+        self.limit = min(2, self.max_limit)
+        self.rate = rate
+        self.tokens = float(max(1, rate or 1))
+        self.filled = time.time()
+        self.window = list()
+        self.cond = threading.Condition()
+
+
+    def acquire(self):
+        '''Blocks until a request may start.
+        Returns the start time, to be handed back to release().'''
+        with self.cond:
+            while self.active >= self.limit:
+                self.cond.wait(1)
+            self.active += 1
+
+        if self.rate:
+            self._take_token()
+        return time.time()
+
+
+    def _take_token(self):
+        '''Waits for the token bucket to allow another request.'''
+        while True:
+            with self.cond:
+                now = time.time()
+                self.tokens = min(max(1.0, self.rate),
+                                  self.tokens + (now - self.filled) * self.rate)
+                self.filled = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+    def release(self, started, overloaded=False):
+        '''Ends a request started by acquire().
+        overloaded is True for 429/5xx answers and timeouts.'''
+        latency = time.time() - started
+        with self.cond:
+            self.active -= 1
+            if overloaded:
+                # Requests already in flight when the limit was cut do not cut it again
+                if started >= self.decreased:
+                    self.limit = max(1, self.limit // 2)
+                    self.decreased = time.time()
+                    self.window = list()
+            else:
+                if self.best is None or latency < self.best:
+                    self.best = latency
+                self.window.append(latency)
+                if len(self.window) >= self.limit:
+                    mean = sum(self.window) / len(self.window)
+                    # The small constant keeps sub-millisecond noise from counting as unstable
+                    if mean <= self.best * LATENCY_FACTOR + 0.01 and self.limit < self.max_limit:
+                        self.limit += 1
+                    self.window = list()
+            self.cond.notify_all()
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+'''
+Provides the D42Trace class.
+It records where time goes in API calls and rendering.
+
+Each finished span is written as one json line to stderr or a file, and
+a summary table of all phases is written to stderr at exit.
+
+DEFINED EXIT :: none
+'''
+import sys
+import json
+import time
+import atexit
+import threading
+
+# Traces not yet closed; each writes its summary at exit
+OPEN = []
+
+
+def _summarize():
+    '''Writes the summary of every open trace; run at exit.'''
+    for trace in list(OPEN):
+        trace.summary()
+
+atexit.register(_summarize)
+
+
+class D42Span(object):
+    '''Times the phases of a single traced event.'''
+
+    def __init__(self, trace, event, fields):
+        '''Class initialization'''
+        self.trace = trace
+        self.event = event
+        self.fields = fields
+        self.phases = list()
+        self.start = self.last = time.time()
+
+
+    def mark(self, phase):
+        '''Ends the current phase; the next one starts now.'''
+        now = time.time()
+        self.phases.append((phase, now - self.last))
+        self.last = now
+
+
+    def set(self, **fields):
+        '''Adds fields to the record written for this span.'''
+        self.fields.update(fields)
+
+
+    def end(self, **fields):
+        '''Finishes the span and hands it to the trace.'''
+        self.fields.update(fields)
+        self.trace.record(self)
+
+
+class D42NullSpan(object):
+    '''Stands in for D42Span when tracing is off.'''
+
+    def mark(self, phase):
+        '''Does nothing; see D42Span.mark().'''
+        pass
+
+    def set(self, **fields):
+        '''Does nothing; see D42Span.set().'''
+        pass
+
+    def end(self, **fields):
+        '''Does nothing; see D42Span.end().'''
+        pass
+
+
+class D42Trace(object):
+    '''Collects spans, writes them as json lines and summarizes them.'''
+    fh = None
+    totals = None
+    order = None
+    transfer = None     # [bytes decoded, bytes on the wire] of API responses
+
+
+    def __init__(self, dest='-'):
+        '''Class initialization'''
+        self.fh = sys.stderr if dest == '-' else open(dest, 'a')
+        self.totals = dict()
+        self.order = list()
+        self.transfer = [0, 0]
+        self.lock = threading.Lock()
+        OPEN.append(self)
+
+
+    def close(self):
+        '''Stops tracing; closes the trace file and skips the summary at exit.'''
+        if self in OPEN:
+            OPEN.remove(self)
+        if self.fh is not sys.stderr:
+            self.fh.close()
+
+
+    def span(self, event, **fields):
+        '''Starts timing an event.'''
+        return D42Span(self, event, fields)
+
+
+    def record(self, span):
+        '''Writes a finished span and adds it to the totals.'''
+        entry = {'event': span.event,
+                 'start': round(span.start, 6),
+                 'total_ms': round((time.time() - span.start) * 1000, 3),
+                 'phases': dict((p, round(s * 1000, 3)) for p, s in span.phases)}
+        entry.update(span.fields)
+
+        with self.lock:
+            self.fh.write(json.dumps(entry, sort_keys=True) + '\n')
+            self.fh.flush()
+            for phase, seconds in span.phases:
+                key = '{}.{}'.format(span.event, phase)
+                if key not in self.totals:
+                    self.totals[key] = [0, 0.0, 0.0]
+                    self.order.append(key)
+                total = self.totals[key]
+                total[0] += 1
+                total[1] += seconds
+                total[2] = max(total[2], seconds)
+            if span.fields.get('bytes') is not None:
+                self.transfer[0] += span.fields['bytes']
+                self.transfer[1] += span.fields.get('wire_bytes') or span.fields['bytes']
+
+
+    def summary(self):
+        '''Writes a table of time spent per phase to stderr.'''
+        if not self.totals:
+            return
+        lines = ['{:<20} {:>7} {:>11} {:>10} {:>10}'.format(
+            'phase', 'count', 'total ms', 'mean ms', 'max ms')]
+        for key in self.order:
+            count, total, most = self.totals[key]
+            lines.append('{:<20} {:>7} {:>11.1f} {:>10.2f} {:>10.2f}'.format(
+                key, count, total * 1000, total * 1000 / count, most * 1000))
+        if self.transfer[0]:
+            lines.append('bytes received {:d} on the wire, {:d} decoded ({:.0%})'.format(
+                self.transfer[1], self.transfer[0],
+                float(self.transfer[1]) / self.transfer[0]))
+        sys.stderr.write('\n'.join(lines) + '\n')
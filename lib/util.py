@@ -5,7 +5,13 @@ Utility functions for doing things and stuff
 DEFINED EXIT :: 199
 '''
 import sys
-import urllib
+import json
+import zlib
+import Queue
+import threading
+
+# zlib level for data written to disk; favors speed over size
+COMPRESS_LEVEL = 1
 
 
 def stderr(message, level='INFO', exit_status=None):
@@ -27,7 +33,12 @@ def confirm(prompt):
     i = 1
     while True:
         sys.stdout.write('{} [y/N]: '.format(prompt))
-        val = input()
+        try:
+            val = input()
+        except EOFError:
+            # Nobody to answer (e.g. run by a daemon)
+            sys.stdout.write('\n')
+            return False
         if val == '':
             return False
         if val.lower() in ['y', 'yes', 'justdoit']:
@@ -61,37 +72,148 @@ def check_deps(obj, lst=None):
     return True
 
 
-def strip_unicode(obj):
+def compress(text):
+    '''Compresses text (e.g. json) before it is written to disk.'''
+    return zlib.compress(text, COMPRESS_LEVEL)
+
+
+def decompress(blob):
+    '''Reverses compress(). Raises ValueError if blob is not compressed.'''
+    try:
+        return zlib.decompress(blob)
+    except zlib.error as e:
+        raise ValueError(str(e))
+
+
+def decode_json(text):
     '''The Michael Lustfield Function For Terminals Who Can't Write Good
     And Wanna Display Other Stuff Good Too...
 
-    It recurses through an object and returns a matching object that has
-    been stripped of unicode.'''
-    if obj is None:
-        return None
-    elif isinstance(obj, (str, unicode)):
-        return str(obj)
-    elif isinstance(obj, (int, float, bool)):
-        return type(obj)(obj)
-    elif isinstance(obj, dict):
-        new = {}
-        for k, v in obj.iteritems():
-            nk = strip_unicode(k)
-            new[nk] = strip_unicode(v)
-        return new
-    elif isinstance(obj, list):
-        new = []
-        for v in obj:
-            new.append(strip_unicode(v))
-        return new
-    else:
-        stderr('Encountered unexpected type while decoding object. {}'.format(type(obj)), 'WARNING')
-        return obj
+    Decodes json and returns an object that has been stripped of unicode.
+    Strings are converted while the decoder builds each object, so the
+    result is not walked a second time. Raises ValueError if text is not
+    json, or is nested deeper than the decoder (which recurses) can follow.'''
+    try:
+        obj = json.loads(text, object_pairs_hook=_strip_pairs)
+    except RuntimeError:
+        raise ValueError('json is nested too deeply to decode')
+    if isinstance(obj, unicode):
+        return obj.encode('utf-8')
+    if isinstance(obj, list):
+        _strip_list(obj)
+    return obj
+
+
+def _strip_pairs(pairs):
+    '''Decoder hook; builds a dictionary without unicode keys or values.'''
+    new = {}
+    for k, v in pairs:
+        # json keys are always strings
+        if type(v) is unicode:
+            v = v.encode('utf-8')
+        elif type(v) is list:
+            _strip_list(v)
+        new[k.encode('utf-8')] = v
+    return new
+
+
+def _strip_list(lst):
+    '''Converts unicode in a list (and lists nested in it) in place.
+    Dictionaries have already been handled by the decoder hook.
+    Uses a stack rather than recursion, so it adds no depth of its own.'''
+    stack = [lst]
+    while stack:
+        cur = stack.pop()
+        for i, v in enumerate(cur):
+            if type(v) is unicode:
+                cur[i] = v.encode('utf-8')
+            elif type(v) is list:
+                stack.append(v)
+
+
+def is_msgpack(blob):
+    '''Returns True if blob starts with a msgpack map (fixmap, map 16 or
+    map 32). No json object or batch line starts with those bytes.'''
+    return bool(blob) and (0x80 <= ord(blob[0]) <= 0x8f or blob[0] in '\xde\xdf')
+
+
+def decode_msgpack(blob):
+    '''Decodes one msgpack object; strings are returned as str, as with
+    decode_json(). Raises ValueError if blob is not valid msgpack or the
+    msgpack library is not installed.'''
+    try:
+        import msgpack
+    except ImportError:
+        raise ValueError('msgpack is not installed')
+    try:
+        return msgpack.unpackb(blob, raw=True)
+    except Exception as e:
+        raise ValueError('Invalid msgpack: {}'.format(e))
+
+
+def iter_msgpack(read, size=65536):
+    '''Yields each msgpack object in a stream as soon as it is complete.
+    read(size) returns the next bytes, or '' at the end of the stream.
+    Raises ValueError as decode_msgpack() does.'''
+    try:
+        import msgpack
+    except ImportError:
+        raise ValueError('msgpack is not installed')
+    unpacker = msgpack.Unpacker(raw=True)
+    fed = 0
+    while True:
+        chunk = read(size)
+        if not chunk:
+            break
+        fed += len(chunk)
+        unpacker.feed(chunk)
+        try:
+            for obj in unpacker:
+                yield obj
+        except Exception as e:
+            raise ValueError('Invalid msgpack: {}'.format(e))
+    if unpacker.tell() != fed:
+        raise ValueError('Invalid msgpack: stream ends part-way through an object')
 
 
 def encode(data):
     '''Return a url encoded string from a dictionary.'''
+    # Imported here; urllib is slow to load and not needed to forward to a daemon
+    import urllib
     try:
         return str(urllib.urlencode(data))
     except:
         return None
+
+
+def pool_map(function, items, workers=1):
+    '''Calls function on every item using at most workers threads.
+    Yields (item, result) pairs as they complete. If function raised,
+    the result is the exception it raised.'''
+    items = list(items)
+    tasks = Queue.Queue()
+    results = Queue.Queue()
+    for item in items:
+        tasks.put(item)
+
+    def work():
+        '''Worker thread; runs until there are no tasks left'''
+        while True:
+            try:
+                item = tasks.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                result = function(item)
+            except BaseException as e:
+                result = e
+            results.put((item, result))
+
+    for _ in range(max(1, min(workers, len(items)))):
+        thread = threading.Thread(target=work)
+        thread.daemon = True
+        thread.start()
+
+    for _ in items:
+        # A timeout keeps the wait interruptible with ^C
+        yield results.get(True, 86400)
@@ -4,7 +4,13 @@ Module to perform operations on D42 devices.
 
 DEFINED EXIT :: 110, 111
 '''
-from lib.util import check_deps, encode
+import csv
+import json
+
+from lib.util import check_deps
+
+# Imports of at least this many rows check names against one fetched list
+BULK_ROWS = 20
 
 
 ##
@@ -30,6 +36,10 @@ def modhook_options(opts):
              action='store_const', const='device.op_get_device', dest='operation',
              help='Get a single device; <device_id|device_name>')
 
+    opts.opt('operations', '-id', '--import-devices',
+             action='store_const', const='device.op_import_devices', dest='operation',
+             help='Create/update devices from a csv or json-lines file; <file>')
+
     #opts.opt('operations', '--delete-device',
     #         action='store_const', const='device.op_delete_device', dest='operation',
     #         help='Delete a device matching XYZ')
@@ -64,6 +74,7 @@ def op_create_device(d42):
         d42.err('API Error', 111, ret['data'])
         return False
 
+    d42.index_add('devices', d42.params['name'])
     d42.out(ret)
     return True
 
@@ -116,7 +127,7 @@ def op_get_device(d42):
         d42.err('API Error', 111, ret['data'])
         return False
 
-    d42.out(ret['data'])
+    d42.out(d42.project(ret['data'], d42.fields))
     return True
 
 
@@ -129,9 +140,9 @@ def op_search_devices(d42):
       ./d42-cli --search-devices -p type=virtual -p building=st1
       ./d42-cli --search-devices
     '''
-    qs = '?{}'.format(encode(d42.params)) if d42.params is not None else ''
-    vs = 'all/' if d42.opts.misc_verbose else ''
-    ret = d42.api('/devices/{}{}'.format(vs, qs))
+    # Only the full listing has every field to choose from
+    vs = 'all/' if d42.opts.misc_verbose or d42.fields else ''
+    ret = d42.search('/devices/{}'.format(vs), 'Devices', d42.params, fields=d42.fields)
 
     if not ret['result']:
         d42.err('API Error', 111, ret['data'])
@@ -141,15 +152,107 @@ def op_search_devices(d42):
     return True
 
 
+def op_import_devices(d42):
+    '''
+    Create or update many devices from a file, several at a time.
+    Required Parameters: file (csv with a header row, or one json object per line)
+    Optional Parameters: mode (create|update|upsert; default upsert)
+    Each row takes the same parameters as --create-device.
+    Examples:
+      ./d42-cli --import-devices -p file=rack12.csv --concurrency 8
+      ./d42-cli --import-devices -p file=rack12.jsonl -p mode=update
+    '''
+    if not check_deps(d42.params, ['file']):
+        d42.err('Required options were not found: file', 110)
+        return False
+
+    mode = d42.params.get('mode', 'upsert')
+    if mode not in ['create', 'update', 'upsert']:
+        d42.err('The mode must be one of: create, update, upsert', 110)
+        return False
+
+    try:
+        rows = _read_rows(d42.params['file'])
+    except (IOError, ValueError) as e:
+        d42.err('Unable to read devices from file: {}'.format(e), 110)
+        return False
+
+    # Checking every row on its own costs more than fetching all names once
+    if len(rows) >= BULK_ROWS:
+        d42.bulk = True
+
+    summary = {'total': len(rows), 'created': 0, 'updated': 0, 'failed': 0}
+    for (num, row), res in d42.bulk_map(lambda r: _import_device(d42, r[1], mode),
+                                        enumerate(rows, 1)):
+        res['row'] = num
+        res['name'] = row.get('name')
+        summary[res['action'] if res['result'] else 'failed'] += 1
+        d42.out(res)
+
+    d42.out({'summary': summary})
+    if summary['failed']:
+        d42.err('{} of {} devices failed to import'.format(
+            summary['failed'], summary['total']), 111)
+        return False
+    return True
+
+
 ##
 # MODULE FUNCTIONS
 ##
 
+def _read_rows(path):
+    '''
+    Reads device rows from a csv file (with header) or a json-lines file.
+    Empty csv fields are dropped so they do not clear existing values.
+    Returns: List of dictionaries
+    '''
+    with open(path) as fh:
+        data = fh.read()
+
+    if data.lstrip().startswith('{'):
+        return [json.loads(l) for l in data.splitlines() if l.strip()]
+
+    rows = []
+    for row in csv.DictReader(data.splitlines()):
+        rows.append(dict((k, v) for k, v in row.items() if k and v not in (None, '')))
+    return rows
+
+
+def _import_device(d42, row, mode):
+    '''
+    Creates or updates a single device row.
+    Returns: Dictionary with result, action and either data or error
+    '''
+    if not check_deps(row, ['name']):
+        return {'result': False, 'action': None, 'error': 'The field name is a required.'}
+
+    exists = _device_exists(d42, row['name'])
+    action = 'updated' if exists else 'created'
+    if exists and mode == 'create':
+        return {'result': False, 'action': action,
+                'error': 'A device with this name already exists.'}
+    if not exists and mode == 'update':
+        return {'result': False, 'action': action,
+                'error': 'No device with this name currently exists.'}
+
+    ret = d42.api('/device/', post=row)
+    if not ret['result']:
+        return {'result': False, 'action': action, 'error': ret['data']}
+    d42.index_add('devices', row['name'])
+    return {'result': True, 'action': action, 'data': ret['data']}
+
+
+
 def _device_exists(d42, devname):
     '''
     Checks whether a device with the given name exists.
     Returns: Boolean
     '''
+    index = d42.index('devices', '/devices/', 'Devices', ['name'])
+    if index is not None:
+        return d42.index_key(devname) in index
+
     ret = d42.api('/devices/name/{}/'.format(devname))
     if not ret['result']:
         return False
@@ -4,7 +4,16 @@ Module to perform operations on D42 ips.
 
 DEFINED EXIT :: 115, 116, 119
 '''
+import random
+
 from lib.util import check_deps, encode, confirm, stderr
+from lib.prefix import parse_address, format_address, host_range
+
+# Parameters of --reserve-ips; anything else is set on each reserved ip
+RESERVE_PARAMS = ['subnet_id', 'count', 'contiguous']
+
+# Rounds of candidates tried after others took the addresses picked
+RESERVE_RETRIES = 5
 
 
 ##
@@ -44,6 +53,11 @@ def modhook_options(opts):
         action='store_const', const='ipaddr.op_request_ip', dest='operation',
         help='Reserve/suggest IP address in given subnet, subnet_id; <reserve_ip>')
 
+    opts.opt(
+        'operations', '-bi', '--reserve-ips',
+        action='store_const', const='ipaddr.op_reserve_ips', dest='operation',
+        help='Reserve many free IPs in a subnet at once; <subnet_id, count>')
+
 
 ##
 # HOOK FUNCTIONS
@@ -65,6 +79,8 @@ def op_create_ip(d42):
 
     if not ret['result']:
         d42.err('API Error', 116, ret['data'])
+    else:
+        d42.index_add('ips', d42.params['ipaddress'])
     d42.out(ret)
 
 
@@ -107,7 +123,7 @@ def op_get_ip(d42):
         d42.err('API Error', 116, ret['data'])
         return False
 
-    d42.out(ret['data'])
+    d42.out(d42.project(ret['data'], d42.fields))
     return True
 
 
@@ -116,8 +132,7 @@ def op_search_ips(d42):
     Search for ips within D42.
     With no parameters specified, all results are returned.
     '''
-    qs = '?{}'.format(encode(d42.params)) if d42.params is not None else ''
-    ret = d42.api('/ips/{}'.format(qs))
+    ret = d42.search('/ips/', 'ips', d42.params, fields=d42.fields)
 
     if not ret['result']:
         d42.err('API Error', 116, ret['data'])
@@ -152,6 +167,113 @@ def op_request_ip(d42):
     return True
 
 
+def op_reserve_ips(d42):
+    '''
+    Reserve several free addresses of a subnet in one go.
+    Required Parameters: subnet_id, count
+    Optional Parameters: contiguous=yes|no (def=no),
+                         any ip field to set on each, e.g. label, notes
+    Free addresses are picked from one fetch of the subnet's ips and
+    reserved --concurrency at a time. Addresses taken by someone else in
+    the meantime are replaced; if the reservation cannot be completed,
+    the addresses already reserved are released again.
+    D42 updates an ip that is created twice, so an allocator racing this
+    one for the same address may overwrite its fields; the loser reports
+    a conflict and picks again, starting at a random address.
+    Examples:
+      ./d42-cli --reserve-ips -p subnet_id=12 -p count=200 -p label=k8s-prod
+      ./d42-cli --reserve-ips -p subnet_id=12 -p count=16 -p contiguous=yes
+    '''
+    if not check_deps(d42.params, ['subnet_id', 'count']):
+        d42.err('Required options were not found: subnet_id, count', 115)
+        return False
+    try:
+        count = int(d42.params['count'])
+    except ValueError:
+        count = 0
+    if count < 1:
+        d42.err('The count must be a positive number', 115)
+        return False
+    contiguous = d42.params.get('contiguous', 'no') == 'yes'
+    # Before the first call, so the session is made with enough connections
+    d42.workers()
+
+    subnet_id = d42.params['subnet_id']
+    ret = d42.api('/subnets/{}/'.format(subnet_id))
+    if not ret['result']:
+        d42.err('API Error', 116, ret['data'])
+        return False
+    try:
+        family, first, last = host_range(ret['data']['network'], ret['data']['mask_bits'])
+    except (KeyError, ValueError) as e:
+        d42.err('Subnet has no usable network: {}'.format(e), 116)
+        return False
+
+    ret = d42.search('/ips/', 'ips', {'subnet_id': subnet_id},
+                     page_size=d42.page_size or 1000, fields=['ip'])
+    if not ret['result']:
+        d42.err('API Error', 116, ret['data'])
+        return False
+    used = set()
+    for record in ret['data']:
+        try:
+            used.add(parse_address(str(record['ip']))[1])
+        except (KeyError, ValueError):
+            continue
+
+    fields = dict((k, v) for k, v in d42.params.items() if k not in RESERVE_PARAMS)
+    fields.setdefault('type', 'reserved')
+    fields.setdefault('available', 'no')
+
+    reserved = []
+    conflicts = 0
+    error = None
+    start = first
+    for _ in range(RESERVE_RETRIES + 1):
+        need = count - len(reserved)
+        batch = _free_addresses(family, first, last, used, need, contiguous, start)
+        if len(batch) < need:
+            error = 'Only {} free addresses{} are left in subnet {}'.format(
+                len(reserved) + len(batch), ' in one block' if contiguous else '', subnet_id)
+            break
+
+        taken = []
+        for address, res in d42.bulk_map(lambda a: _reserve_ip(d42, a, subnet_id, fields), batch):
+            used.add(parse_address(address)[1])
+            if res['result']:
+                taken.append(res)
+            elif res.get('conflict'):
+                conflicts += 1
+            elif error is None:
+                error = res['error']
+
+        if contiguous and len(taken) < need and error is None:
+            # A block with a hole in it is no use; try the next one
+            error = _release(d42, taken)
+            taken = []
+        reserved.extend(taken)
+        if error is not None or len(reserved) == count:
+            break
+        # Allocators that picked the same addresses would collide again
+        start = random.randint(first, last)
+    else:
+        error = 'Others kept taking the addresses picked; {} conflicts'.format(conflicts)
+
+    if error is not None or len(reserved) < count:
+        failed = _release(d42, reserved)
+        d42.err('Unable to reserve {} addresses'.format(count), 116,
+                {'error': error, 'conflicts': conflicts, 'released': len(reserved),
+                 'release_error': failed})
+        return False
+
+    for res in reserved:
+        d42.index_add('ips', res['ip'])
+    reserved.sort(key=lambda r: parse_address(r['ip'])[1])
+    d42.out({'subnet_id': subnet_id, 'conflicts': conflicts,
+             'reserved': [{'ip': r['ip'], 'id': r['id']} for r in reserved]})
+    return True
+
+
 def op_delete_ip(d42):
     '''
     Delete a ip.
@@ -167,6 +289,8 @@ def op_delete_ip(d42):
             return False
 
     ret = d42.api('/ips/{}/'.format(d42.params['ip_id']), post=d42.params, delete=True)
+    # Only the id is known here, so the index cannot be patched
+    d42.index_drop('ips')
 
     if not ret['result']:
         d42.err('API Error', 116, ret['data'])
@@ -180,11 +304,86 @@ def op_delete_ip(d42):
 # MODULE FUNCTIONS
 ##
 
+def _free_addresses(family, first, last, used, count, contiguous=False, start=None):
+    '''
+    Picks up to count addresses between first and last that are not in used,
+    from start (def=first) up and then wrapping around; with contiguous,
+    only a block of count in a row will do.
+    Returns: List of address strings
+    '''
+    if start is None:
+        start = first
+    picked = []
+    for low, high in [(start, last), (first, start - 1)]:
+        if len(picked) >= count:
+            break
+        if contiguous:
+            # A block cannot wrap around the end of the subnet
+            picked = []
+        address = low
+        while address <= high and len(picked) < count:
+            if address in used:
+                if contiguous:
+                    picked = []
+            else:
+                picked.append(address)
+            address += 1
+    if contiguous and len(picked) < count:
+        return []
+    return [format_address(family, a) for a in picked]
+
+
+def _reserve_ip(d42, address, subnet_id, fields):
+    '''
+    Reserves one address, unless someone else already has it.
+    Creating an ip updates any existing one, so it is looked up first, and
+    the reply tells whether the address was taken in between.
+    Returns: Dictionary with result and ip/id, or conflict or error
+    '''
+    ret = d42.api('/ips/?{}'.format(encode({'ip': address, 'subnet_id': subnet_id})))
+    if not ret['result']:
+        return {'result': False, 'error': ret['data']}
+    if ret['data'].get('ips'):
+        return {'result': False, 'conflict': True}
+
+    ret = d42.api('/ips/', post=dict(fields, ipaddress=address))
+    if not ret['result']:
+        return {'result': False, 'error': ret['data']}
+    # msg is [text, id, ip, result, added]
+    msg = ret['data'].get('msg') if isinstance(ret['data'], dict) else None
+    if isinstance(msg, list) and len(msg) > 4 and not msg[4]:
+        return {'result': False, 'conflict': True}
+    return {'result': True, 'ip': address,
+            'id': msg[1] if isinstance(msg, list) and len(msg) > 1 else None}
+
+
+def _release(d42, reserved):
+    '''
+    Deletes ips reserved by op_reserve_ips().
+    Returns: None, or a description of those that could not be released
+    '''
+    known = [r for r in reserved if r['id'] is not None]
+    failed = [r['ip'] for r in reserved if r['id'] is None]
+    for res, ret in zip(known, d42.api_many([('/ips/{}/'.format(r['id']), None, True)
+                                             for r in known])):
+        if not ret['result']:
+            failed.append(res['ip'])
+    d42.index_drop('ips')
+    if failed:
+        return 'Left reserved: {}'.format(', '.join(failed))
+    return None
+
+
 def _ip_exists(d42, params):
     '''
     Checks whether a ip with the given name exists.
     Returns: Boolean
     '''
+    if params.keys() == ['ip']:
+        index = d42.index('ips', '/ips/', 'ips', ['ip'])
+        if index is not None:
+            return d42.index_key(params['ip']) in index
+
     qs = '?{}'.format(encode(params))
     ret = d42.api('/ips/{}'.format(qs))
     if not ret['result']:
@@ -34,6 +34,11 @@ def modhook_options(opts):
         action='store_true', dest='misc_verbose',
         help='Provide more verbose output from searches')
 
+    opts.opt(
+        'misc', '--concurrency',
+        action='store', type=int, dest='misc_concurrency', default=4, metavar='4',
+        help='Maximum simultaneous API requests for bulk operations; def=4')
+
 
 ##
 # HOOK FUNCTIONS
@@ -124,8 +124,7 @@ def op_search_passwords(d42):
     Search for passwords within D42.
     With no parameters specified, all results are returned.
     '''
-    qs = '?{}'.format(encode(d42.params)) if d42.params is not None else ''
-    ret = d42.api('/passwords/{}'.format(qs))
+    ret = d42.search('/passwords/', 'Passwords', d42.params, fields=d42.fields)
 
     if not ret['result']:
         d42.err('API Error', 126, ret['data'])
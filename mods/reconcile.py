@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+'''
+Module to make D42 vlans and subnets match a desired state file.
+
+DEFINED EXIT :: 145, 146, 149
+'''
+from lib.util import check_deps, confirm, decode_json
+
+# What can be reconciled, how it is fetched and changed, and what identifies it
+KINDS = {
+    'vlans': {'query': '/vlans/', 'key': 'vlans', 'id': 'vlan_id',
+              'match': ['number'],
+              'create': '/vlans/', 'update': '/vlans/{}/', 'delete': '/vlans/{}/'},
+    'subnets': {'query': '/subnets/', 'key': 'subnets', 'id': 'subnet_id',
+                'match': ['network', 'mask_bits'],
+                'create': '/subnets/', 'update': '/subnets/', 'delete': '/subnets/{}/'},
+}
+
+# Kinds in the order they are compared and planned
+ORDER = ['vlans', 'subnets']
+
+# Changes are applied in this order; each phase runs in parallel.
+# Subnets may refer to vlans, so vlans are added before and removed after them.
+PHASES = [
+    [('vlans', 'create'), ('vlans', 'update')],
+    [('subnets', 'create'), ('subnets', 'update'), ('subnets', 'delete')],
+    [('vlans', 'delete')],
+]
+
+
+##
+# MODULE HOOKS
+##
+
+def modhook_options(opts):
+    ''' MODULE HOOK :: OPTIONS '''
+    # Group: operations
+    opts.opt(
+        'operations', '-ap', '--apply',
+        action='store_const', const='reconcile.op_apply', dest='operation',
+        help='Create, update or delete vlans and subnets to match <file>')
+
+    # Group: reconcile
+    opts.opt(
+        'reconcile', '--plan',
+        action='store_true', dest='reconcile_plan',
+        help='Show the changes --apply would make without making them')
+
+
+##
+# HOOK FUNCTIONS
+##
+
+def op_apply(d42):
+    '''
+    Make vlans and subnets in D42 match a desired state file.
+    Required Parameters: file (json: {"vlans": [...], "subnets": [...]})
+    Vlans are matched on number and subnets on network and mask_bits. Only
+    the fields given are compared, and only changed fields are sent. Objects
+    with "state": "absent" are deleted; objects not in the file are left alone.
+    Examples:
+      ./d42-cli --apply -p file=network.json --plan
+      ./d42-cli --apply -p file=network.json --concurrency 8 --yes
+    '''
+    if not check_deps(d42.params, ['file']):
+        d42.err('Required options were not found: file', 145)
+        return False
+
+    # Before the first call, so the session is made with enough connections
+    d42.workers()
+
+    try:
+        desired = _read_state(d42.params['file'])
+    except (IOError, ValueError) as e:
+        d42.err('Unable to read desired state: {}'.format(e), 145)
+        return False
+
+    changes = []
+    unchanged = 0
+    for kind in ORDER:
+        if kind not in desired:
+            continue
+        ret = _diff(d42, kind, desired[kind])
+        if not ret['result']:
+            d42.err(ret['error'], ret['exit_status'], ret.get('data'))
+            return False
+        changes.extend(ret['changes'])
+        unchanged += ret['unchanged']
+
+    summary = {'create': 0, 'update': 0, 'delete': 0, 'unchanged': unchanged}
+    for change in changes:
+        summary[change['action']] += 1
+
+    if d42.opts.reconcile_plan or not changes:
+        for change in changes:
+            d42.out(change)
+        d42.out({'plan': summary})
+        return True
+
+    if summary['delete'] and not d42.opts.misc_yes:
+        if not confirm('Apply {} changes, deleting {} objects?'.format(len(changes), summary['delete'])):
+            d42.err('Terminated at user request', 149)
+            return False
+
+    summary['failed'] = 0
+    for phase in PHASES:
+        batch = [c for c in changes if (c['kind'], c['action']) in phase]
+        for change, res in d42.bulk_map(lambda c: _apply_change(d42, c), batch):
+            res.update(change)
+            if not res['result']:
+                summary['failed'] += 1
+            d42.out(res)
+
+    # Bulk existence indexes no longer match the server
+    for kind in KINDS:
+        d42.index_drop(kind)
+
+    d42.out({'summary': summary})
+    if summary['failed']:
+        d42.err('{} of {} changes failed'.format(summary['failed'], len(changes)), 146)
+        return False
+    return True
+
+
+##
+# MODULE FUNCTIONS
+##
+
+def _read_state(path):
+    '''
+    Reads a desired state file: a json object of kind => list of objects.
+    Returns: Dictionary
+    '''
+    with open(path) as fh:
+        desired = decode_json(fh.read())
+
+    if not isinstance(desired, dict):
+        raise ValueError('expected a json object of kinds')
+    for kind, items in desired.items():
+        if kind not in KINDS:
+            raise ValueError('unknown kind "{}"; use {}'.format(kind, ', '.join(sorted(KINDS))))
+        if not isinstance(items, list) or not all(isinstance(i, dict) for i in items):
+            raise ValueError('{} must be a list of objects'.format(kind))
+    return desired
+
+
+def _diff(d42, kind, items):
+    '''
+    Compares desired objects of one kind with what D42 has.
+    Current objects are fetched in one paged search and matched by key.
+    Returns: Dictionary with result and changes, or error and exit_status
+    '''
+    spec = KINDS[kind]
+    ret = d42.search(spec['query'], spec['key'], {}, page_size=d42.page_size or 1000)
+    if not ret['result']:
+        return {'result': False, 'error': 'Unable to fetch {}'.format(kind),
+                'exit_status': 146, 'data': ret['data']}
+    current = dict((d42.index_key(*[r.get(f) for f in spec['match']]), r) for r in ret['data'])
+
+    changes = []
+    unchanged = 0
+    seen = set()
+    for item in items:
+        if not check_deps(item, spec['match']):
+            return {'result': False, 'exit_status': 145,
+                    'error': 'Every one of {} needs: {}'.format(kind, ', '.join(spec['match']))}
+        key = d42.index_key(*[item[f] for f in spec['match']])
+        if key in seen:
+            return {'result': False, 'exit_status': 145,
+                    'error': 'Listed twice in {}: {}'.format(kind, ' '.join(key))}
+        seen.add(key)
+
+        match = dict((f, item[f]) for f in spec['match'])
+        fields = dict((k, v) for k, v in item.items() if k != 'state')
+        record = current.get(key)
+        if item.get('state') == 'absent':
+            if record is None:
+                unchanged += 1
+                continue
+            changes.append({'kind': kind, 'action': 'delete', 'match': match,
+                            'id': record.get(spec['id'])})
+        elif record is None:
+            changes.append({'kind': kind, 'action': 'create', 'match': match, 'fields': fields})
+        else:
+            changed = dict((k, v) for k, v in fields.items() if k not in spec['match']
+                           and d42.index_key(record.get(k)) != d42.index_key(v))
+            if not changed:
+                unchanged += 1
+                continue
+            changes.append({'kind': kind, 'action': 'update', 'match': match,
+                            'id': record.get(spec['id']), 'fields': changed})
+    return {'result': True, 'changes': changes, 'unchanged': unchanged}
+
+
+def _apply_change(d42, change):
+    '''
+    Makes one planned change.
+    Returns: Dictionary with result and either data or error
+    '''
+    spec = KINDS[change['kind']]
+    path = spec[change['action']].format(change.get('id'))
+    if change['action'] == 'delete':
+        ret = d42.api(path, delete=True)
+    elif change['action'] == 'update' and '{}' not in spec['update']:
+        # Updated through the create endpoint, which matches on these fields
+        ret = d42.api(path, post=dict(change['fields'], **change['match']))
+    else:
+        ret = d42.api(path, post=change['fields'])
+
+    if not ret['result']:
+        return {'result': False, 'error': ret['data']}
+    return {'result': True, 'data': ret['data']}
@@ -4,7 +4,18 @@ Module to perform operations on D42 subnets.
 
 DEFINED EXIT :: 130, 131, 134
 '''
+import array
+import socket
+import bisect
+
 from lib.util import check_deps, encode, confirm
+from lib.prefix import D42PrefixTree, FAMILIES, parse_address, parse_network, format_address, host_range
+
+# Parameters of --lookup-subnets; anything else narrows the subnets indexed
+LOOKUP_PARAMS = ['ip', 'network', 'mask_bits', 'file', 'match']
+
+# Parameters of --subnet-usage; anything else narrows the subnets reported
+USAGE_PARAMS = ['ranges']
 
 
 ##
@@ -39,6 +50,16 @@ def modhook_options(opts):
         action='store_const', const='subnet.op_delete_subnet', dest='operation',
         help='Delete a subnet; <subnet_id>')
 
+    opts.opt(
+        'operations', '-ls', '--lookup-subnets',
+        action='store_const', const='subnet.op_lookup_subnets', dest='operation',
+        help='Find subnets containing <ip>, overlapping <network, mask_bits>, or per line of <file>')
+
+    opts.opt(
+        'operations', '-su', '--subnet-usage',
+        action='store_const', const='subnet.op_subnet_usage', dest='operation',
+        help='Report used and free addresses of subnets; use --params to refine')
+
 
 ##
 # HOOK FUNCTIONS
@@ -60,6 +81,8 @@ def op_create_subnet(d42):
 
     if not ret['result']:
         d42.err('API Error', 131, ret['data'])
+    else:
+        d42.index_add('subnets', d42.params['network'], d42.params['mask_bits'])
     d42.out(ret)
 
 
@@ -102,7 +125,7 @@ def op_get_subnet(d42):
         d42.err('API Error', 131, ret['data'])
         return False
 
-    d42.out(ret['data'])
+    d42.out(d42.project(ret['data'], d42.fields))
     return True
 
 
@@ -111,8 +134,7 @@ def op_search_subnets(d42):
     Search for subnets within D42.
     With no parameters specified, all results are returned.
     '''
-    qs = '?{}'.format(encode(d42.params)) if d42.params is not None else ''
-    ret = d42.api('/subnets/{}'.format(qs))
+    ret = d42.search('/subnets/', 'subnets', d42.params, fields=d42.fields)
 
     if not ret['result']:
         d42.err('API Error', 131, ret['data'])
@@ -137,6 +159,8 @@ def op_delete_subnet(d42):
             return False
 
     ret = d42.api('/subnets/{}/'.format(d42.params['subnet_id']), post=d42.params, delete=True)
+    # Only the id is known here, so the index cannot be patched
+    d42.index_drop('subnets')
 
     if not ret['result']:
         d42.err('API Error', 131, ret['data'])
@@ -146,10 +170,187 @@ def op_delete_subnet(d42):
     return True
 
 
+def op_lookup_subnets(d42):
+    '''
+    Find subnets by address using a local index of every subnet.
+    Required Parameters: ip, network (with mask_bits or as a/bits), or file
+    Optional Parameters: match=longest|all (def=longest; for ip and file),
+                         any search field to limit which subnets are indexed
+    With ip, the subnets containing it are returned; with network, every
+    subnet that contains or is contained by it. With file, each line is an
+    address and one result per line is returned.
+    '''
+    match = d42.params.get('match', 'longest')
+    if match not in ['longest', 'all']:
+        d42.err('Invalid match type: {}'.format(match), 130)
+        return False
+
+    fh = None
+    try:
+        if 'ip' in d42.params:
+            parse_network(d42.params['ip'])
+        elif 'network' in d42.params:
+            parse_network(d42.params['network'], d42.params.get('mask_bits'))
+        elif 'file' in d42.params:
+            fh = open(d42.params['file'])
+        else:
+            d42.err('Required options were not found: ip, network or file', 130)
+            return False
+    except ValueError as e:
+        d42.err(str(e), 130)
+        return False
+    except IOError as e:
+        d42.err('Unable to read file', 130, str(e))
+        return False
+
+    tree = _subnet_tree(d42, dict((k, v) for k, v in d42.params.items()
+                                  if k not in LOOKUP_PARAMS))
+    if tree is None:
+        return False
+    find = tree.containing if match == 'all' else tree.longest
+
+    if 'ip' in d42.params:
+        d42.out(find(d42.params['ip']))
+    elif 'network' in d42.params:
+        d42.out(tree.overlapping(d42.params['network'], d42.params.get('mask_bits')))
+    else:
+        d42.out(_lookup_lines(fh, find))
+    return True
+
+
+def op_subnet_usage(d42):
+    '''
+    Report how many addresses of each subnet are used, and which are free.
+    Subnets and IPs are each fetched once; nothing is requested per subnet.
+    Optional Parameters: ranges=no (leave out free_ranges),
+                         any search field to limit which subnets are reported
+    Examples:
+      ./d42-cli --subnet-usage --out ndjson
+      ./d42-cli --subnet-usage -p name=lab -p ranges=no
+    '''
+    ranges = d42.params.get('ranges', 'yes') != 'no'
+
+    used = _used_addresses(d42)
+    if used is None:
+        return False
+
+    ret = d42.search('/subnets/', 'subnets',
+                     dict((k, v) for k, v in d42.params.items() if k not in USAGE_PARAMS),
+                     page_size=d42.page_size or 1000)
+    if not ret['result']:
+        d42.err('API Error', 131, ret['data'])
+        return False
+
+    d42.out(d42.project(_usage(subnet, used, ranges), d42.fields) for subnet in ret['data'])
+    return True
+
+
 ##
 # MODULE FUNCTIONS
 ##
 
+def _used_addresses(d42):
+    '''
+    Fetches every IP once and sorts the addresses as integers.
+    IPv4 addresses are kept in a compact array; IPv6 ones do not fit.
+    Returns: {family: sorted sequence}, or None after reporting an error
+    '''
+    ret = d42.search('/ips/', 'ips', {}, page_size=d42.page_size or 1000, fields=['ip'])
+    if not ret['result']:
+        d42.err('API Error', 131, ret['data'])
+        return None
+
+    found = dict((f, set()) for f in FAMILIES)
+    for record in ret['data']:
+        try:
+            family, value = parse_address(str(record['ip']))
+        except (KeyError, ValueError):
+            continue
+        found[family].add(value)
+
+    used = {socket.AF_INET: array.array('L', sorted(found.pop(socket.AF_INET)))}
+    used[socket.AF_INET6] = sorted(found.pop(socket.AF_INET6))
+    return used
+
+
+def _usage(subnet, used, ranges=True):
+    '''
+    Counts the used and free host addresses of a subnet from the sorted
+    addresses of _used_addresses(); the addresses in it are found by bisection.
+    Returns: Dictionary
+    '''
+    report = dict((k, subnet.get(k)) for k in ['subnet_id', 'name', 'network', 'mask_bits'])
+    try:
+        family, first, last = host_range(subnet['network'], subnet['mask_bits'])
+    except (KeyError, ValueError) as e:
+        report['error'] = 'Unusable network: {}'.format(e)
+        return report
+
+    addresses = used[family]
+    lo = bisect.bisect_left(addresses, first)
+    hi = bisect.bisect_right(addresses, last)
+    size = last - first + 1
+    report['size'] = size
+    report['used'] = hi - lo
+    report['free'] = size - report['used']
+    report['percent_used'] = round(100.0 * report['used'] / size, 2)
+
+    if ranges:
+        free = []
+        start = first
+        for address in addresses[lo:hi]:
+            if address > start:
+                free.append(_free_range(family, start, address - 1))
+            start = address + 1
+        if start <= last:
+            free.append(_free_range(family, start, last))
+        report['free_ranges'] = free
+    return report
+
+
+def _free_range(family, start, end):
+    '''Returns a range of addresses as "start-end", or one address.'''
+    if start == end:
+        return format_address(family, start)
+    return '{}-{}'.format(format_address(family, start), format_address(family, end))
+
+
+def _subnet_tree(d42, params):
+    '''
+    Builds a prefix tree from the subnets matching params.
+    Returns: D42PrefixTree, or None after reporting an error
+    '''
+    ret = d42.search('/subnets/', 'subnets', params, page_size=d42.page_size or 1000)
+    if not ret['result']:
+        d42.err('API Error', 131, ret['data'])
+        return None
+    tree = D42PrefixTree()
+    for subnet in ret['data']:
+        try:
+            # Values are only shown, so keep just the --fields asked for
+            tree.insert(subnet['network'], subnet['mask_bits'], d42.project(subnet, d42.fields))
+        except (KeyError, ValueError):
+            # Nothing can be found in a subnet without a usable network
+            continue
+    return tree
+
+
+def _lookup_lines(fh, find):
+    '''
+    Looks up the address on each line of a file.
+    Yields: {ip, subnets} or {ip, error} per non-empty line
+    '''
+    with fh:
+        for line in fh:
+            address = line.strip()
+            if not address:
+                continue
+            try:
+                yield {'ip': address, 'subnets': find(address)}
+            except ValueError as e:
+                yield {'ip': address, 'error': str(e)}
+
+
 def _subnet_exists(d42, params):
     '''
     Checks whether a subnet with the given name exists.
@@ -157,6 +358,9 @@ def _subnet_exists(d42, params):
     '''
     if not check_deps(params, ['network', 'mask_bits']):
         d42.err('Function requires network and mask_bits', 130)
+    index = d42.index('subnets', '/subnets/', 'subnets', ['network', 'mask_bits'])
+    if index is not None:
+        return d42.index_key(params['network'], params['mask_bits']) in index
     qs = '?{}'.format(encode({'network': params['network'], 'mask_bits': params['mask_bits']}))
     ret = d42.api('/subnets/{}'.format(qs))
     if not ret['result']:
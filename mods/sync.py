@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+'''
+Module to keep a local snapshot of the D42 inventory for --offline use.
+
+DEFINED EXIT :: 140, 141
+'''
+from lib.snapshot import TABLES
+
+
+##
+# MODULE HOOKS
+##
+
+def modhook_options(opts):
+    ''' MODULE HOOK :: OPTIONS '''
+    # Group: operations
+    opts.opt(
+        'operations', '--sync',
+        action='store_const', const='sync.op_sync', dest='operation',
+        help='Update the local snapshot used by --offline; <full=yes>, <tables>')
+
+
+##
+# HOOK FUNCTIONS
+##
+
+def op_sync(d42):
+    '''
+    Copy devices, ips, subnets and vlans into the local snapshot.
+    The first sync of a table is full; later ones only fetch what changed.
+    Optional Parameters: full=yes, tables=devices,ips,subnets,vlans
+    '''
+    if d42.offline:
+        d42.err('Unable to sync while offline', 140)
+        return False
+
+    names = sorted(TABLES)
+    if 'tables' in d42.params:
+        names = [n.strip() for n in d42.params['tables'].split(',') if n.strip()]
+        unknown = [n for n in names if n not in TABLES]
+        if unknown:
+            d42.err('Unknown tables requested: {}'.format(', '.join(unknown)), 140)
+            return False
+    full = d42.params.get('full') == 'yes'
+
+    snapshot = d42.get_snapshot()
+    summary = {}
+    for name in names:
+        ret = snapshot.sync(d42, name, full, page_size=d42.page_size or 1000)
+        if not ret['result']:
+            d42.err('Unable to sync {}'.format(name), 141, ret['data'])
+            return False
+        summary[name] = {'mode': ret['mode'], 'records': ret['records']}
+
+    d42.out({'snapshot': snapshot.path, 'tables': summary})
+    return True
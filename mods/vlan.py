@@ -3,6 +3,11 @@
 Module to perform operations on D42 vlans.
 '''
 from lib.util import check_deps, encode, confirm
+from lib.bitmap import D42Bitmap
+
+# Vlan ids are 12 bits; 0 and 4095 are reserved
+VLAN_IDS = 4096
+VLAN_RANGE = (1, 4094)
 
 
 ##
@@ -37,6 +42,11 @@ def modhook_options(opts):
         action='store_const', const='vlan.op_delete_vlan', dest='operation',
         help='Delete a vlan; requires <vlan_id>')
 
+    opts.opt(
+        'operations', '-fv', '--free-vlans',
+        action='store_const', const='vlan.op_free_vlans', dest='operation',
+        help='List unused vlan numbers; <count, range, switch>')
+
 
 ##
 # HOOK FUNCTIONS
@@ -45,23 +55,42 @@ def modhook_options(opts):
 def op_create_vlan(d42):
     '''
     Create a new vlan in D42.
-    Required Parameters: number
-    Optional Parameters: http://api.device42.com/#update-vlans
+    Required Parameters: number (or auto, to use the lowest free number)
+    Optional Parameters: http://api.device42.com/#update-vlans,
+                         range=low-high (with number=auto)
+    Examples:
+      ./d42-cli --create-vlan -p number=auto -p range=3000-3099 -p name=ml_test
     '''
     if not check_deps(d42.params, ['number']):
         d42.err('Required options were not found: number', 135)
         return False
 
-    if _vlan_exists(d42, {'number': d42.params['number']}):
+    params = dict(d42.params)
+    if params['number'] == 'auto':
+        try:
+            low, high = _vlan_range(params.pop('range', None))
+        except ValueError as e:
+            d42.err(str(e), 135)
+            return False
+        free = _free_vlans(d42, 1, low, high, params.get('switch'))
+        if free is None:
+            return False
+        if not free:
+            d42.err('No free vlan numbers from {} to {}'.format(low, high), 135)
+            return False
+        params['number'] = free[0]
+    elif _vlan_exists(d42, {'number': params['number']}):
         d42.err('An existing vlan matched this create request', 135)
         return False
 
-    ret = d42.api('/vlans/', post=d42.params)
+    ret = d42.api('/vlans/', post=params)
 
     if not ret['result']:
         d42.err('API Error', 136, ret['data'])
         return False
 
+    d42.index_add('vlans', params['number'])
+    ret['number'] = params['number']
     d42.out(ret)
     return True
 
@@ -107,7 +136,7 @@ def op_get_vlan(d42):
         d42.err('API Error', 136, ret['data'])
         return False
 
-    d42.out(ret['data'])
+    d42.out(d42.project(ret['data'], d42.fields))
     return True
 
 
@@ -116,8 +145,7 @@ def op_search_vlans(d42):
     Search for vlans within D42.
     With no parameters specified, all results are returned.
     '''
-    qs = '?{}'.format(encode(d42.params)) if d42.params is not None else ''
-    ret = d42.api('/vlans/{}'.format(qs))
+    ret = d42.search('/vlans/', 'vlans', d42.params, fields=d42.fields)
 
     if not ret['result']:
         d42.err('API Error', 136, ret['data'])
@@ -142,6 +170,8 @@ def op_delete_vlan(d42):
             return False
 
     ret = d42.api('/vlans/{}/'.format(d42.params['vlan_id']), post=d42.params, delete=True)
+    # Only the id is known here, so the index cannot be patched
+    d42.index_drop('vlans')
 
     if not ret['result']:
         d42.err('API Error', 136, ret['data'])
@@ -151,10 +181,75 @@ def op_delete_vlan(d42):
     return True
 
 
+def op_free_vlans(d42):
+    '''
+    List vlan numbers not used by any vlan, lowest first.
+    Optional Parameters: count (def=1), range=low-high (def=1-4094),
+                         switch (only vlans on this switch, or on none, count)
+    All vlans are fetched once; nothing is requested per number.
+    Examples:
+      ./d42-cli --free-vlans -p count=10 -p range=3000-3999
+    '''
+    try:
+        count = int(d42.params.get('count', 1))
+        low, high = _vlan_range(d42.params.get('range'))
+    except ValueError as e:
+        d42.err('Invalid count or range: {}'.format(e), 135)
+        return False
+
+    free = _free_vlans(d42, count, low, high, d42.params.get('switch'))
+    if free is None:
+        return False
+    if len(free) < count:
+        d42.err('Only {} free vlan numbers from {} to {}'.format(len(free), low, high), 135, free)
+        return False
+
+    d42.out(free)
+    return True
+
+
 ##
 # MODULE FUNCTIONS
 ##
 
+def _vlan_range(text):
+    '''
+    Parses a range of vlan numbers, e.g. "100-199".
+    Returns: (low, high); raises ValueError if it is not a valid range
+    '''
+    if not text:
+        return VLAN_RANGE
+    low, _, high = str(text).partition('-')
+    low, high = int(low), int(high or low)
+    if not VLAN_RANGE[0] <= low <= high <= VLAN_RANGE[1]:
+        raise ValueError('vlan range must be within {}-{}'.format(*VLAN_RANGE))
+    return low, high
+
+
+def _free_vlans(d42, count, low, high, switch=None):
+    '''
+    Finds free vlan numbers from one fetch of every vlan, kept in a bitmap.
+    With switch, vlans on other switches do not count as used.
+    Returns: List of up to count numbers, or None after reporting an error
+    '''
+    ret = d42.search('/vlans/', 'vlans', {}, page_size=d42.page_size or 1000,
+                     fields=['number', 'switches'])
+    if not ret['result']:
+        d42.err('API Error', 136, ret['data'])
+        return None
+
+    used = D42Bitmap(VLAN_IDS)
+    for vlan in ret['data']:
+        switches = [s.get('name') if isinstance(s, dict) else s for s in vlan.get('switches') or []]
+        if switch is not None and switches and switch not in switches:
+            continue
+        try:
+            used.add(int(vlan['number']))
+        except (KeyError, TypeError, ValueError):
+            continue
+    return used.free(count, low, high)
+
+
 def _vlan_exists(d42, params):
     '''
     Checks whether a vlan with the given name exists.
@@ -162,6 +257,10 @@ def _vlan_exists(d42, params):
     '''
     if not check_deps(params, ['number']) and not check_deps(params, ['vlan_id']):
         d42.err('Function requires number or id', 135)
+    if params.keys() == ['number']:
+        index = d42.index('vlans', '/vlans/', 'vlans', ['number'])
+        if index is not None:
+            return d42.index_key(params['number']) in index
     qs = '?{}'.format(encode(params))
     ret = d42.api('/vlans/{}'.format(qs))
     if not ret['result']: